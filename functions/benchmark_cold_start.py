@@ -0,0 +1,336 @@
+"""
+Reports the cold start time of every cloud function entry point.
+
+Each entry point is imported in a fresh interpreter with `-X importtime`, so earlier imports do not
+hide the cost of later ones. The functions need their deployment `config.py`, by default it is looked up
+in the function's own directory (use `--config-dir` to specify another directory).
+
+The handlers defer their heavy imports (e.g. `google.cloud.storage`) to their first call, so the import
+of the entry point alone is not the full cold start. After the import, the script also imports the
+modules that are imported inside the functions a handler can reach (the "first call"), without calling
+the handler. The reachable functions are found statically: the public functions of the entry point and
+every function of the entry point or the common modules it loaded that they refer to (by name).
+Deferred imports of optional features (`OPTIONAL_IMPORTS`) are imported and reported separately, so the
+first call is the cold start of a handler's default path. Deferred imports that are not installed are reported.
+
+Usage:
+    python functions/benchmark_cold_start.py [--runs 5] [--top 10] [--max-ms 500] [--config-dir path]
+
+With `--max-ms` the script exits with status 1 when any entry point's median cold start (import and
+first call, without optional imports) exceeds it, so it can be used to catch cold start regressions.
+"""
+
+import argparse
+import ast
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(FUNCTIONS_DIR)
+COMMON_DIR = os.path.join(FUNCTIONS_DIR, "common")
+
+ENTRY_POINTS = ["get_images", "query_forms", "replay_forms", "sync_images"]
+
+# Deferred imports (and their submodules) that are only done by optional features, and the feature.
+OPTIONAL_IMPORTS = {
+    "flask": "ndjson output",
+    "google.auth": "HTTP sharding",
+    "google.oauth2": "HTTP sharding",
+    "google.cloud.storage.blob": "shard workers",
+    "opentelemetry": "metrics export",
+}
+
+# Separates the first call from the optional imports in the `-X importtime` output.
+OPTIONAL_MARKER = "-- optional imports --"
+
+
+def measure(entry_point: str, config_dir: str) -> (int, int, int, list, list, list):
+    """
+    Imports an entry point, and its deferred imports, in a fresh interpreter.
+
+    :return: The import, first call and optional imports time in microseconds., The (cumulative
+        microseconds, module) of each import before the optional imports., The (cumulative microseconds,
+        module) of each optional import., The deferred imports that could not be imported.
+    :rtype: int, int, int, list[(int, str)], list[(int, str)], list[str]
+    """
+
+    python_path = [REPOSITORY_DIR, COMMON_DIR, config_dir or os.path.join(FUNCTIONS_DIR, entry_point)]
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--child", entry_point],
+        cwd=REPOSITORY_DIR,
+        env=environment,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    if process.returncode != 0:
+        error = "\n".join(line for line in process.stderr.splitlines() if not line.startswith("import time:"))
+        raise RuntimeError(f"Could not import '{entry_point}':\n{error}")
+
+    output = dict(line.split(" ", 1) for line in process.stdout.splitlines() if " " in line)
+    missing = output.get("missing", "").split()
+
+    # Lines look like: "import time:       self [us] |  cumulative | imported package"
+    modules = []
+    optional_modules = []
+    current = modules
+    for line in process.stderr.splitlines():
+        if line == OPTIONAL_MARKER:
+            current = optional_modules
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        current.append((int(cumulative), module.rstrip()))
+
+    return (
+        int(output["import_us"]),
+        int(output["first_call_us"]),
+        int(output["optional_us"]),
+        modules,
+        optional_modules,
+        missing,
+    )
+
+
+def _child(entry_point: str):
+    """
+    Runs in the measuring interpreter: imports the entry point, then its deferred imports.
+    """
+
+    # `__import__` (unlike `importlib.import_module`) goes through the import statement's path, which
+    # `-X importtime` reports.
+    start = time.perf_counter()
+    __import__(f"functions.{entry_point}.main")
+    import_us = int((time.perf_counter() - start) * 1000000)
+
+    # The entry point and the common modules it loaded (flat or as package).
+    entry_file = os.path.join(FUNCTIONS_DIR, entry_point, "main.py")
+    files = {
+        os.path.abspath(module.__file__) for module in list(sys.modules.values())
+        if getattr(module, "__file__", None) and (
+            os.path.abspath(module.__file__).startswith(COMMON_DIR + os.sep)
+            or os.path.abspath(module.__file__) == entry_file
+        )
+    }
+
+    deferred_imports = _deferred_imports(_reachable_functions(entry_file, files))
+    optional_imports = sorted(name for name in deferred_imports if _optional_feature(name))
+    first_call_imports = sorted(name for name in deferred_imports if not _optional_feature(name))
+
+    missing = []
+    first_call_us = _import_all(first_call_imports, missing)
+
+    sys.stderr.write(OPTIONAL_MARKER + "\n")
+    sys.stderr.flush()
+    optional_us = _import_all(optional_imports, missing)
+
+    print(f"import_us {import_us}")
+    print(f"first_call_us {first_call_us}")
+    print(f"optional_us {optional_us}")
+    print(f"missing {' '.join(missing)}")
+
+
+def _import_all(names: list, missing: list) -> int:
+    """
+    Imports the specified modules, adds the modules that are not installed to `missing`.
+
+    :return: The time in microseconds.
+    :rtype: int
+    """
+
+    start = time.perf_counter()
+    for name in names:
+        try:
+            __import__(name)
+        except ImportError:
+            missing.append(name)
+
+    return int((time.perf_counter() - start) * 1000000)
+
+
+def _optional_feature(name: str) -> str:
+    """
+    Returns the optional feature that the specified module is imported by, or `None`.
+    """
+
+    return next(
+        (
+            feature for module, feature in OPTIONAL_IMPORTS.items()
+            if name == module or name.startswith(module + ".")
+        ),
+        None
+    )
+
+
+def _reachable_functions(entry_file: str, files: set) -> list:
+    """
+    Returns the functions that the public functions of the entry point can reach, by following every name
+    they refer to (calls, attributes and references) to the functions, methods and classes of the files.
+    """
+
+    definitions = {}
+    entry_functions = []
+    for file in files:
+        with open(file) as source:
+            tree = ast.parse(source.read())
+
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                definitions.setdefault(node.name, []).append(node)
+            elif isinstance(node, ast.ClassDef):
+                # Creating an instance runs its `__init__`.
+                definitions.setdefault(node.name, []).extend(
+                    child for child in node.body
+                    if isinstance(child, ast.FunctionDef) and child.name == "__init__"
+                )
+
+        if file == entry_file:
+            entry_functions = [
+                node for node in tree.body
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and not node.name.startswith("_")
+            ]
+
+    reachable = {}
+    pending = list(entry_functions)
+    while pending:
+        function = pending.pop()
+        if id(function) in reachable:
+            continue
+        reachable[id(function)] = function
+
+        for node in ast.walk(function):
+            name = node.id if isinstance(node, ast.Name) else node.attr if isinstance(node, ast.Attribute) else None
+            pending.extend(definitions.get(name, []))
+
+    return list(reachable.values())
+
+
+def _deferred_imports(functions: list) -> set:
+    """
+    Returns the modules that are imported inside the specified functions.
+    """
+
+    names = set()
+    for function in functions:
+        for node in ast.walk(function):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                # `from package import module` imports a module, `from module import name` does not.
+                for alias in node.names:
+                    name = f"{node.module}.{alias.name}"
+                    names.add(name if _is_module(name) else node.module)
+
+    return names
+
+
+def _is_module(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, AttributeError, ValueError):
+        return False
+
+
+def _direct_imports(entry_point: str, modules: list) -> list:
+    """
+    Returns the imports done by the entry module itself.
+
+    The importtime output lists the imports of a module before the module itself,
+    indented two spaces deeper per level.
+    """
+
+    entry_module = f"functions.{entry_point}.main"
+    names = [module.strip() for _, module in modules]
+    if entry_module not in names:
+        return []
+
+    direct_imports = []
+    for cumulative, module in reversed(modules[:names.index(entry_module)]):
+        depth = (len(module) - len(module.lstrip())) // 2
+        if depth == 0:
+            break
+        if depth == 1:
+            direct_imports.append((cumulative, module.strip()))
+
+    return direct_imports
+
+
+def _first_call_imports(entry_point: str, modules: list) -> list:
+    """
+    Returns the top-level imports done after the entry module (the deferred imports).
+    """
+
+    entry_module = f"functions.{entry_point}.main"
+    names = [module.strip() for _, module in modules]
+    if entry_module not in names:
+        return []
+
+    return _top_level_imports(modules[names.index(entry_module) + 1:])
+
+
+def _top_level_imports(modules: list) -> list:
+    return [(cumulative, module) for cumulative, module in modules if not module.startswith(" ")]
+
+
+def main() -> int:
+    if sys.argv[1:2] == ["--child"]:
+        _child(sys.argv[2])
+        return 0
+
+    parser = argparse.ArgumentParser(description="Reports the cold start time of every entry point.")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per entry point (the median is reported).")
+    parser.add_argument("--top", type=int, default=10, help="Amount of slowest top-level imports to report.")
+    parser.add_argument("--max-ms", type=float, help="Fail when an entry point's median cold start exceeds this.")
+    parser.add_argument("--config-dir", help="Directory with the config.py to use for all entry points.")
+    parser.add_argument("entry_points", nargs="*", default=ENTRY_POINTS, help="Entry points to measure.")
+    arguments = parser.parse_args()
+
+    exceeded = []
+    for entry_point in arguments.entry_points:
+        runs = [measure(entry_point, arguments.config_dir) for _ in range(arguments.runs)]
+        import_ms = statistics.median(run[0] for run in runs) / 1000
+        first_call_ms = statistics.median(run[1] for run in runs) / 1000
+        optional_ms = statistics.median(run[2] for run in runs) / 1000
+        median_ms = statistics.median(run[0] + run[1] for run in runs) / 1000
+
+        print(
+            f"{entry_point}: {median_ms:.1f} ms "
+            f"(import {import_ms:.1f} ms, first call {first_call_ms:.1f} ms, median of {arguments.runs}), "
+            f"optional features {optional_ms:.1f} ms"
+        )
+
+        _, _, _, modules, optional_modules, missing = runs[-1]
+        print("  import:")
+        for cumulative, module in sorted(_direct_imports(entry_point, modules), reverse=True)[:arguments.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+
+        print("  first call:")
+        for cumulative, module in sorted(_first_call_imports(entry_point, modules), reverse=True)[:arguments.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+
+        print("  optional features (not in the cold start):")
+        for cumulative, module in sorted(_top_level_imports(optional_modules), reverse=True)[:arguments.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {module} ({_optional_feature(module.strip())})")
+
+        if missing:
+            print(f"  not installed (not measured): {', '.join(missing)}")
+
+        if arguments.max_ms is not None and median_ms > arguments.max_ms:
+            exceeded.append(entry_point)
+
+    if exceeded:
+        print(f"Cold start exceeds {arguments.max_ms} ms: {', '.join(exceeded)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import json
+
+from utils import compile_path
+
+
+class Aggregation:
+    """
+    This class aggregates a value over all forms of a scan, without keeping the forms.
+
+    Operators:
+    - `count`: The amount of forms.
+    - `group_by`: The amount of forms per value of `path` (at most `limit` values).
+    - `min`, `max`: The smallest/biggest value of `path`.
+    - `distinct`: The distinct values of `path` (at most `limit`).
+    """
+
+    OPERATORS = ("count", "group_by", "min", "max", "distinct")
+
+    def __init__(self, name: str, operator: str, path: str = None, limit: int = 1000):
+        if operator not in self.OPERATORS:
+            raise ValueError(f"Unknown aggregation operator '{operator}', expected one of {self.OPERATORS}")
+        if operator != "count" and not path:
+            raise ValueError(f"Aggregation operator '{operator}' requires a path")
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            raise ValueError(f"Aggregation limit must be a positive integer, got {json.dumps(limit)}")
+
+        self.name = name
+        self.operator = operator
+        self.path = path
+        self._path = compile_path(path) if path else None
+        self.limit = limit
+
+        self._count = 0
+        self._value = None
+        self._groups = {}
+        self._distinct = set()
+        self._truncated = False
+
+    def add(self, data: dict):
+        """
+        Adds a form to the aggregation.
+
+        :param data: The raw data of the form.
+        :type data: dict
+        """
+
+        self._count += 1
+
+        if self.operator == "count":
+            return
+
+        value = self._path.get(data)
+
+        if self.operator == "group_by":
+            key = self._to_key(value)
+            if key in self._groups:
+                self._groups[key] += 1
+            elif len(self._groups) < self.limit:
+                self._groups[key] = 1
+            else:
+                self._truncated = True
+        elif self.operator == "distinct":
+            key = self._to_key(value)
+            if key in self._distinct:
+                return
+            if len(self._distinct) < self.limit:
+                self._distinct.add(key)
+            else:
+                self._truncated = True
+        elif value is not None:
+            try:
+                if self._value is None or (value < self._value if self.operator == "min" else value > self._value):
+                    self._value = value
+            except TypeError:
+                # Values of different types (e.g. str and int) can not be compared, these are ignored.
+                pass
+
+    def result(self):
+        """
+        Returns the result of the aggregation.
+
+        :return: The aggregated value.
+        :rtype: int | dict | list | any
+        """
+
+        if self.operator == "count":
+            return self._count
+        if self.operator == "group_by":
+            groups = sorted(self._groups.items(), key=lambda group: (-group[1], group[0]))
+            return {
+                "groups": [{"value": json.loads(key), "count": count} for key, count in groups],
+                "truncated": self._truncated
+            }
+        if self.operator == "distinct":
+            return {
+                "values": [json.loads(key) for key in sorted(self._distinct)],
+                "truncated": self._truncated
+            }
+
+        return self._value
+
+    @staticmethod
+    def _to_key(value) -> str:
+        # Values are kept serialized, so unhashable values can be counted and `1` and `"1"` stay distinct.
+        return json.dumps(value, sort_keys=True)
+
+
+def aggregations_from_dict(aggregations: list) -> list:
+    """
+    Creates the aggregations of a query.
+
+    Aggregation syntax: {"op": {operator}, "path": {path}, "name": {name}, "limit": {limit}}
+        name is optional, by default it is "{op}" or "{op}:{path}".
+        limit is optional, and only used by `group_by` and `distinct`.
+
+    :param aggregations: The aggregations to create.
+    :type aggregations: list[dict]
+
+    :raises ValueError: If an aggregation is invalid.
+
+    :return: The created aggregations.
+    :rtype: list[Aggregation]
+    """
+
+    result = []
+    for aggregation in aggregations:
+        if not isinstance(aggregation, dict) or not isinstance(aggregation.get("op"), str):
+            raise ValueError(f"Invalid aggregation {json.dumps(aggregation)}, expected an object with an 'op'")
+
+        operator = aggregation["op"].lower()
+        path = aggregation.get("path")
+        default_name = f"{operator}:{path}" if path else operator
+
+        result.append(Aggregation(
+            name=aggregation.get("name", default_name),
+            operator=operator,
+            path=path,
+            limit=aggregation.get("limit", 1000)
+        ))
+
+    return result
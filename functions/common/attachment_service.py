@@ -1,18 +1,46 @@
+import hashlib
+import json
+import logging
 import requests
+import time
 
-from config import IMAGE_STORE_BUCKET
+from concurrency_limiter import get_limiter
+from concurrent.futures import ThreadPoolExecutor
+from config import IMAGE_STORE_BUCKET, IMAGE_STORE_PATH
+from constant import CONTENT_HASH_TIMEOUT, CONTENT_INDEX_PATH, STORAGE_BATCH_SIZE
 
 from form_object import Attachment, Form
+from functools import lru_cache
+from metrics import Metrics, NULL_METRICS
 from mimetypes import guess_type
-from requests_retry_session import get_requests_session
+from profiler import profile_call
+from requests_retry_session import get_requests_session, get_retry_count
+from typing import Optional
 
 
 class AttachmentService:
-    def __init__(self, storage_client, **kwargs):
+    def __init__(
+            self,
+            storage_client,
+            metrics: Metrics = NULL_METRICS,
+            deduplicate: bool = False,
+            copy_sources: list = None,
+            **kwargs
+    ):
         self.storage_client = storage_client
-        self.requests_session = get_requests_session(**kwargs)
+        self.metrics = metrics
+        self.deduplicate = deduplicate
+        self.copy_sources = copy_sources or []
+        self.validate_copy_sources(self.copy_sources)
         self.bucket = storage_client.get_bucket(IMAGE_STORE_BUCKET)
 
+        # Shared limit of concurrent requests to the image host, every attempt of the session goes through it.
+        self.limiter = get_limiter("image_host")
+        self.requests_session = get_requests_session(limiter=self.limiter, **kwargs)
+
+        # The content hash lookup is only an optimization, so it is not retried (a missing image would pay twice).
+        self.head_session = get_requests_session(retries=0, limiter=self.limiter)
+
     def exists(self, attachment: Attachment):
         """
         Checks for the existence of the specified attachment in storage.
@@ -23,8 +51,71 @@ class AttachmentService:
         :rtype: bool
         """
 
-        blob = self.bucket.get_blob(attachment.bucket_path)
-        return blob and blob.exists()
+        with self.metrics.span("attachment_exists"):
+            blob = self.bucket.get_blob(attachment.bucket_path)
+            exists = blob and blob.exists()
+
+        if exists:
+            self.metrics.increment("attachment_cache_hits")
+
+        return exists
+
+    def exists_many(self, attachments: list) -> list:
+        """
+        Checks for the existence of the specified attachments in storage.
+        The metadata requests are grouped in batch requests of `STORAGE_BATCH_SIZE` objects.
+
+        :param attachments: The attachments to check.
+        :type attachments: list[Attachment]
+        :return: For each attachment: `True` if it exists in the specified bucket, `False` otherwise.
+        :rtype: list[bool]
+        """
+
+        results = []
+        for start in range(0, len(attachments), STORAGE_BATCH_SIZE):
+            results.extend(self._exists_batch(attachments[start:start + STORAGE_BATCH_SIZE]))
+
+        return results
+
+    def _exists_batch(self, attachments: list, tries: int = 5, delay: float = 1, backoff: float = 2) -> list:
+        """
+        Checks the existence of at most `STORAGE_BATCH_SIZE` attachments in one batch request.
+        Sub-requests that fail with a retryable status (429, 5xx) are batched again, with an exponential backoff.
+        """
+
+        from google.api_core import exceptions
+
+        results = [None] * len(attachments)
+        pending = list(range(len(attachments)))
+
+        for attempt in range(1, tries + 1):
+            batch = _get_metadata_batch_class()(self.storage_client)
+
+            with self.metrics.span("attachment_exists_batch"):
+                with batch:
+                    for index in pending:
+                        self.bucket.blob(attachments[index].bucket_path).reload()
+
+            failed = []
+            for index, response in zip(pending, batch.responses):
+                if response.status_code == 404:
+                    results[index] = False
+                elif 200 <= response.status_code < 300:
+                    results[index] = True
+                    self.metrics.increment("attachment_cache_hits")
+                elif response.status_code in RETRYABLE_STATUS_CODES and attempt < tries:
+                    failed.append(index)
+                else:
+                    raise exceptions.from_http_status(response.status_code, response.text)
+
+            if not failed:
+                break
+
+            self.metrics.increment("attachment_exists_retries", len(failed))
+            time.sleep(delay * backoff ** (attempt - 1))
+            pending = failed
+
+        return results
 
     def find_missing_attachments(self, form: Form):
         """
@@ -35,12 +126,34 @@ class AttachmentService:
         :return: A list of the specified form's attachments that are missing in storage.
         :rtype: list
         """
-        return [att for att in form.attachments if not self.exists(att)]
+        return self.find_missing_attachments_many([form])[0]
+
+    def find_missing_attachments_many(self, forms: list) -> list:
+        """
+        Scans the specified forms for attachments that are missing in storage.
+        The attachments of all forms are checked in shared batch requests.
+
+        :param forms: The forms to scan.
+        :type forms: list[Form]
+        :return: For each form: a list of its attachments that are missing in storage.
+        :rtype: list[list]
+        """
+
+        attachments = [attachment for form in forms for attachment in form.attachments]
+        exists = iter(self.exists_many(attachments))
+
+        return [
+            [attachment for attachment in form.attachments if not next(exists)]
+            for form in forms
+        ]
 
     def download(self, attachment: Attachment):
         """
         Downloads the specified attachment to its bucket path.
 
+        When deduplicating, the attachment is copied within storage if identical content
+        has been stored before.
+
         :param attachment: The attachment to download
         :type attachment: Attachment
         :return: `True` if the download was successful, `False` otherwise.,
@@ -48,23 +161,255 @@ class AttachmentService:
         :rtype: int, str
         """
 
+        content_key = None
+        if self.deduplicate:
+            content_key = self._request_content_key(attachment)
+            if content_key:
+                success, response = self._copy_indexed_content(content_key, attachment)
+                if success:
+                    return success, response
+
         try:
-            file_response = self.requests_session.get(attachment.download_url)
+            with self.metrics.span("attachment_download"):
+                file_response = self.requests_session.get(attachment.download_url)
         except (
                 requests.exceptions.ConnectionError,
                 requests.exceptions.HTTPError,
                 requests.exceptions.RetryError,
         ) as exception:
+            self.metrics.increment("attachment_download_errors")
             return False, str(exception)
 
+        self.metrics.increment("attachment_download_retries", get_retry_count(file_response))
+
         if file_response.status_code == requests.codes.ok:
             content_type, _ = guess_type(attachment.bucket_path)
 
-            image_store_blob = self.bucket.blob(attachment.bucket_path)
-            image_store_blob.upload_from_string(
-                file_response.content, content_type=content_type
-            )
+            with self.metrics.span("attachment_upload"):
+                image_store_blob = self.bucket.blob(attachment.bucket_path)
+                image_store_blob.upload_from_string(
+                    file_response.content, content_type=content_type
+                )
+
+            self.metrics.increment("attachment_bytes_transferred", len(file_response.content))
+
+            if self.deduplicate:
+                content_key = content_key or self._get_content_key(file_response.headers)
+                if content_key:
+                    self._index_content(content_key, attachment)
         else:
+            self.metrics.increment("attachment_download_errors")
             return False, file_response.text
 
         return True, f"{attachment.download_url} downloaded to {attachment.bucket_path}"
+
+    def repair(self, attachment: Attachment):
+        """
+        Restores the specified attachment to its bucket path.
+
+        The configured copy sources are checked first, an attachment found there is copied
+        within storage. The attachment is only downloaded when no copy source has it.
+
+        Copy source syntax: {"bucket": {bucket name}, "path": {replacement of IMAGE_STORE_PATH}}
+            path is optional, by default the attachment's bucket path is used.
+
+        :param attachment: The attachment to restore.
+        :type attachment: Attachment
+        :return: `True` if the restore was successful, `False` otherwise.,
+            The response message.
+        :rtype: int, str
+        """
+
+        from google.api_core import exceptions
+
+        for copy_source in self.copy_sources:
+            source_path = self._get_copy_source_path(copy_source, attachment)
+
+            try:
+                with self.metrics.span("copy_source_lookup"):
+                    source_blob = self.storage_client.bucket(copy_source["bucket"]).get_blob(source_path)
+
+                if source_blob:
+                    self.copy_blob(source_blob, attachment)
+                    self.metrics.increment("attachment_copy_source_hits")
+                    return True, f"gs://{copy_source['bucket']}/{source_path} copied to {attachment.bucket_path}"
+            except exceptions.GoogleAPICallError as exception:
+                # E.g. no access to the copy source, the next source (or the download) is tried instead.
+                self.metrics.increment("attachment_copy_source_errors")
+                logging.warning(
+                    f"Could not copy gs://{copy_source['bucket']}/{source_path} to {attachment.bucket_path}: "
+                    f"{str(exception)}"
+                )
+
+        return self.download(attachment)
+
+    def repair_many(self, attachments: list) -> list:
+        """
+        Restores the specified attachments concurrently (see `repair`).
+        The amount of concurrent downloads is adapted by the image host's limiter, so pass as many
+        attachments at once as possible (e.g. those of a page of forms) to make use of it.
+
+        :param attachments: The attachments to restore.
+        :type attachments: list[Attachment]
+        :return: For each attachment: `True` if the restore was successful, `False` otherwise.,
+            The response message.
+        :rtype: list[(bool, str)]
+        """
+
+        if len(attachments) <= 1:
+            return [self.repair(attachment) for attachment in attachments]
+
+        with ThreadPoolExecutor(max_workers=min(len(attachments), self.limiter.max_limit)) as executor:
+            return list(executor.map(profile_call(self.repair), attachments))
+
+    @staticmethod
+    def validate_copy_sources(copy_sources: list):
+        """
+        Checks the copy sources (see `repair` for their syntax), so an invalid one does not fail a run halfway.
+
+        :param copy_sources: The copy sources to check.
+        :type copy_sources: list[dict]
+
+        :raises ValueError: If a copy source is invalid.
+        """
+
+        if not isinstance(copy_sources, list):
+            raise ValueError(f"Invalid attachment copy sources {json.dumps(copy_sources)}, expected a list")
+
+        for copy_source in copy_sources:
+            if (
+                    not isinstance(copy_source, dict)
+                    or not isinstance(copy_source.get("bucket"), str)
+                    or not copy_source["bucket"]
+                    or not isinstance(copy_source.get("path", ""), str)
+            ):
+                raise ValueError(
+                    f"Invalid attachment copy source {json.dumps(copy_source)}, "
+                    "expected an object with a 'bucket' (and optionally a 'path')"
+                )
+
+    def copy_blob(self, source_blob, attachment: Attachment):
+        """
+        Copies the specified blob to the attachment's bucket path.
+        The copy is done by storage itself, so the content is not downloaded by this function.
+
+        :param source_blob: The blob to copy.
+        :type source_blob: google.cloud.storage.blob.Blob
+        :param attachment: The attachment to copy to.
+        :type attachment: Attachment
+        """
+
+        with self.metrics.span("attachment_copy"):
+            destination_blob = self.bucket.blob(attachment.bucket_path)
+
+            # Rewriting large objects (or between locations) can take multiple calls.
+            token, _, _ = destination_blob.rewrite(source_blob)
+            while token is not None:
+                token, _, _ = destination_blob.rewrite(source_blob, token=token)
+
+        self.metrics.increment("attachment_bytes_copied", source_blob.size or 0)
+
+    def _request_content_key(self, attachment: Attachment) -> Optional[str]:
+        try:
+            with self.metrics.span("attachment_head"):
+                head_response = self.head_session.head(
+                    attachment.download_url, allow_redirects=True, timeout=CONTENT_HASH_TIMEOUT
+                )
+        except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.HTTPError,
+                requests.exceptions.RetryError,
+                requests.exceptions.Timeout,
+        ) as exception:
+            logging.info(f"Could not get content hash of {attachment.download_url}: {str(exception)}")
+            return None
+
+        if head_response.status_code != requests.codes.ok:
+            return None
+
+        return self._get_content_key(head_response.headers)
+
+    def _copy_indexed_content(self, content_key: str, attachment: Attachment) -> (bool, str):
+        from google.api_core import exceptions
+
+        try:
+            with self.metrics.span("content_index_lookup"):
+                index_blob = self.bucket.get_blob(f"{CONTENT_INDEX_PATH}/{content_key}")
+                if not index_blob:
+                    return False, "Content is not indexed"
+
+                source_path = index_blob.download_as_text()
+                source_blob = self.bucket.get_blob(source_path) if source_path != attachment.bucket_path else None
+
+            if not source_blob:
+                return False, f"Indexed content '{source_path}' is not available"
+
+            self.copy_blob(source_blob, attachment)
+        except exceptions.GoogleAPICallError as exception:
+            # E.g. the indexed content was deleted meanwhile, the attachment is downloaded instead.
+            logging.warning(f"Could not copy indexed content to {attachment.bucket_path}: {str(exception)}")
+            return False, str(exception)
+
+        self.metrics.increment("attachment_cache_hits")
+
+        return True, f"{attachment.download_url} copied from {source_path} to {attachment.bucket_path}"
+
+    def _index_content(self, content_key: str, attachment: Attachment):
+        with self.metrics.span("content_index_update"):
+            index_blob = self.bucket.blob(f"{CONTENT_INDEX_PATH}/{content_key}")
+            index_blob.upload_from_string(attachment.bucket_path, content_type="text/plain")
+
+    @staticmethod
+    def _get_copy_source_path(copy_source: dict, attachment: Attachment) -> str:
+        source_path = copy_source.get("path")
+        if source_path is None or not attachment.bucket_path.startswith(IMAGE_STORE_PATH):
+            return attachment.bucket_path
+
+        return f"{source_path}{attachment.bucket_path[len(IMAGE_STORE_PATH):]}"
+
+    @staticmethod
+    def _get_content_key(headers) -> Optional[str]:
+        """
+        Returns the content hash key of a download, based on its `Content-MD5` response header.
+
+        Only `Content-MD5` identifies the content itself: an `ETag` only identifies a version of one
+        download URL, and download URLs differ per form entry, so content without it is not indexed.
+
+        :return: The content hash key, or `None` if the content can not be identified.
+        :rtype: str | None
+        """
+
+        content_md5 = headers.get("Content-MD5")
+        if not content_md5:
+            return None
+
+        return hashlib.sha256(f"md5:{content_md5}".encode("utf-8")).hexdigest()
+
+
+# Statuses of batch sub-requests that are retried.
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+@lru_cache(maxsize=None)
+def _get_metadata_batch_class():
+    # The storage library is only imported when batches are used.
+    from google.cloud.storage.batch import Batch
+
+    class _MetadataBatch(Batch):
+        """
+        A storage batch that keeps every sub-response, instead of raising on the first failed one.
+        (A missing object is an expected 404 response when checking for existence.)
+        """
+
+        def __init__(self, client):
+            super().__init__(client)
+            self.responses = []
+
+        def _finish_futures(self, responses):
+            self.responses = responses
+
+            for target, response in zip(self._target_objects, responses):
+                if target is not None and 200 <= response.status_code < 300:
+                    target._properties = response.json()
+
+    return _MetadataBatch
@@ -0,0 +1,166 @@
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class AdaptiveLimiter:
+    """
+    This class limits the amount of in-flight requests to an upstream service, adapting the limit
+    to the upstream's latency and errors (AIMD):
+
+    - Additive increase: while latency is stable and at least half of the limit is in use, the limit grows
+        by about one per limit's worth of requests (an unused limit is not evidence that the upstream copes).
+    - Multiplicative decrease: on an overload (429, 5xx, connection errors) the limit is multiplied
+        by `backoff_ratio`, at most once per (smoothed) latency so a burst of errors counts once.
+    - Latency gradient: when the smoothed latency rises above `latency_tolerance` times the
+        baseline (lowest) latency, the limit shrinks by one.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            initial_limit: int = 4,
+            min_limit: int = 1,
+            max_limit: int = 32,
+            backoff_ratio: float = 0.5,
+            latency_tolerance: float = 2.0,
+            smoothing: float = 0.2,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._baseline_latency = None
+        self._smoothed_latency = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @contextmanager
+    def request(self):
+        """
+        Waits for a free slot and holds it for the enclosed request.
+
+        The yielded sample should be marked as overloaded when the upstream responded with 429/5xx.
+        Exceptions raised in the enclosed block count as an overload. The enclosed block should be a single
+        attempt, so retries should not be done within the block (see `LimitedSession`).
+
+        Example:
+            with limiter.request() as sample:
+                response = session.get(url)
+                sample.overloaded = is_overload_status(response.status_code)
+        """
+
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+        sample = Sample()
+        start = time.monotonic()
+        try:
+            yield sample
+        except Exception:
+            sample.overloaded = True
+            raise
+        finally:
+            self._release(time.monotonic() - start, sample.overloaded)
+
+    def _release(self, latency: float, overloaded: bool):
+        with self._condition:
+            # The requests in flight while this request was (including itself).
+            in_flight = self._in_flight
+            self._in_flight -= 1
+
+            now = time.monotonic()
+            previous_limit = self.limit
+
+            if overloaded:
+                if now - self._last_decrease > (self._smoothed_latency or 0):
+                    self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                    self._last_decrease = now
+            else:
+                self._update_latency(latency)
+
+                if self._smoothed_latency > self._baseline_latency * self.latency_tolerance:
+                    self._limit = max(self.min_limit, self._limit - 1)
+                elif in_flight * 2 >= self.limit:
+                    self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+            if self.limit != previous_limit:
+                logging.debug(f"Concurrency limit of '{self.name}' changed to {self.limit}")
+
+            self._condition.notify_all()
+
+    def _update_latency(self, latency: float):
+        if self._smoothed_latency is None:
+            self._smoothed_latency = latency
+        else:
+            self._smoothed_latency += self.smoothing * (latency - self._smoothed_latency)
+
+        # The baseline follows the lowest latency, and slowly drifts up so a single outlier does not stick.
+        if self._baseline_latency is None or latency < self._baseline_latency:
+            self._baseline_latency = latency
+        else:
+            self._baseline_latency += 0.01 * (latency - self._baseline_latency)
+
+
+class Sample:
+    """
+    The outcome of a single request through an `AdaptiveLimiter`.
+    """
+
+    __slots__ = ("overloaded",)
+
+    def __init__(self):
+        self.overloaded = False
+
+
+def is_overload_status(status_code: int) -> bool:
+    """
+    Checks if an HTTP status code means the upstream is overloaded (or failing).
+
+    :param status_code: The HTTP status code.
+    :type status_code: int
+
+    :return: `True` for 429 and 5xx status codes, `False` otherwise.
+    :rtype: bool
+    """
+
+    return status_code == 429 or status_code >= 500
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, **kwargs) -> AdaptiveLimiter:
+    """
+    Returns the limiter of an upstream service, shared by all services in this instance.
+    The keyword arguments (see `AdaptiveLimiter`) are only used when the limiter is created.
+
+    :param name: The name of the upstream service.
+    :type name: str
+
+    :return: The shared limiter.
+    :rtype: AdaptiveLimiter
+    """
+
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, **kwargs)
+        return _limiters[name]
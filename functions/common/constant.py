@@ -4,3 +4,10 @@ ANSWERS_PAGES_KEY = 'AnswersJson'
 DS_ROW_ID_KEY = "DSRowId"
 FORM_CODE_KEY = 'FormCode'
 IMAGE_FILE_EXTENSIONS = [".jpg", ".jpeg", ".png"]
+CONTENT_INDEX_PATH = "content_index"
+CONTENT_HASH_TIMEOUT = 10  # Seconds to wait for the content hash (HEAD) of an attachment
+DEAD_LETTER_PATH = "dead_letter"
+STORAGE_BATCH_SIZE = 100  # Cloud Storage JSON API: maximum amount of calls per batch request
+MAX_RANGE_COMBINATIONS = 100000  # Maximum amount of storage prefixes a `form_storage_suffix` may unpack to
+MAX_SHARD_MESSAGE_BYTES = 8 * 1024 * 1024  # Pub/Sub messages and cloud function requests are limited to 10 MB
+HTTP_COORDINATOR_SECONDS = 480  # Time an HTTP coordinator may take, cloud functions are stopped after 540 seconds
@@ -4,6 +4,7 @@ import re
 from json.decoder import JSONDecodeError
 from urllib.parse import urlencode
 
+from concurrency_limiter import get_limiter
 from config import (
     COORDINATE_SERVICE,
     COORDINATE_SERVICE_AUTHENTICATION,
@@ -13,20 +14,86 @@ from config import (
 )
 
 from requests.exceptions import ConnectionError, HTTPError
-from requests_retry_session import get_requests_session
-from utils import get_secret, get_from_path
+from requests_retry_session import IDEMPOTENT_METHODS, get_requests_session, get_retry_count
+from utils import get_secret
 from form_object import Form
-from typing import Optional
+from metrics import Metrics, NULL_METRICS
+from typing import NamedTuple, Optional
+
+# Address key syntax: {zip code}{house number}[_{suffix}], e.g. '1234AB12' or '1234AB12_A'
+ADDRESS_KEY_REGEX = re.compile(r"^(\d{4}[A-Z]{2})(\d+)(?:_(.+))?$", re.IGNORECASE)
+
+# Feature layer fields of an address.
+ADDRESS_FIELDS = ("postcode", "huisnummer", "huisext")
+
+# Maximum amount of addresses per feature layer query.
+COORDINATE_BATCH_SIZE = 50
+
+
+class Address(NamedTuple):
+    """
+    This class represents a normalized (hashable) address.
+    """
+
+    zip_code: str
+    house_number: str
+    suffix: Optional[str] = None
+
+    @staticmethod
+    def create(zip_code, house_number, suffix=None):
+        return Address(
+            str(zip_code).replace(" ", "").upper(),
+            str(int(house_number)),
+            str(suffix).strip().upper() if suffix not in (None, "") else None
+        )
+
+
+def parse_address(key) -> Optional[Address]:
+    """
+    Parses an address key.
+
+    :param key: The address key, e.g. '1234AB12_A'.
+    :type key: str
+
+    :return: The parsed address, or `None` if the key could not be parsed.
+    :rtype: Address | None
+    """
+
+    if not isinstance(key, str):
+        return None
+
+    result = ADDRESS_KEY_REGEX.match(key.strip())
+    if not result:
+        return None
+
+    return Address.create(result.group(1), result.group(2), result.group(3))
 
 
 class CoordinateService:
-    def __init__(self, **kwargs):
-        self.requests_session = get_requests_session(**kwargs)
-        self.token = self._request_authentication_token()
+    def __init__(self, metrics: Metrics = NULL_METRICS, **kwargs):
+        self.metrics = metrics
+        self._coordinate_cache = {}
+
+        # Shared limit of concurrent requests to the feature layer, every attempt of the session goes through it.
+        # Queries are read only, so posted (batch) queries are retried like the others.
+        self.limiter = get_limiter("feature_layer")
+        self.requests_session = get_requests_session(
+            limiter=self.limiter, retry_methods=[*IDEMPOTENT_METHODS, "POST"], **kwargs
+        )
+
+        # The token is requested once, outside the feature layer's limit (its status is not retried).
+        self.token_session = get_requests_session(**kwargs)
+
+        with self.metrics.span("arcgis_token"):
+            self.token = self._request_authentication_token()
 
     def form_to_geojson(self, form: Form) -> Optional[dict]:
-        address = self._extract_form_address(form)
-        latitude, longitude = self._find_house_coordinates(**address)
+        address = self.extract_form_address(form)
+        if not address:
+            return None
+
+        with self.metrics.span("coordinate_lookup"):
+            latitude, longitude = self.find_coordinates(address)
 
         if latitude is None or longitude is None:
             return None
@@ -45,6 +112,95 @@ class CoordinateService:
             ],
         }
 
+    def find_coordinates(self, address: Address) -> (float, float):
+        """
+        Returns the latitude and longitude of the specified address, found coordinates are cached.
+
+        :param address: The address to find.
+        :type address: Address
+
+        :return: Latitude and longitude of the address in epsg4326 format, or `None, None`.
+        :rtype: float | None, float | None
+        """
+
+        if address in self._coordinate_cache:
+            self.metrics.increment("coordinate_cache_hits")
+            return self._coordinate_cache[address]
+
+        coordinates = self._find_house_coordinates(*address)
+        if coordinates[0] is not None:
+            self._coordinate_cache[address] = coordinates
+
+        return coordinates
+
+    def prefetch_form_coordinates(self, forms: list):
+        """
+        Looks up the coordinates of the specified forms together (see `find_coordinates_many`),
+        so converting the forms afterwards does not query the feature layer per form.
+
+        :param forms: The forms to look up.
+        :type forms: list[Form]
+        """
+
+        addresses = [parse_address(self._get_form_address_key(form)) for form in forms]
+        addresses = [address for address in addresses if address]
+
+        if addresses:
+            self.find_coordinates_many(addresses)
+
+    def find_coordinates_many(self, addresses: list) -> dict:
+        """
+        Returns the latitude and longitude of the specified addresses.
+        Uncached addresses are queried together, at most `COORDINATE_BATCH_SIZE` per query.
+        Addresses that are not found by a successful query are cached as not found.
+
+        :param addresses: The addresses to find.
+        :type addresses: list[Address]
+
+        :return: The latitude and longitude (or `None, None`) of each address.
+        :rtype: dict[Address, (float | None, float | None)]
+        """
+
+        uncached = [address for address in dict.fromkeys(addresses) if address not in self._coordinate_cache]
+
+        for start in range(0, len(uncached), COORDINATE_BATCH_SIZE):
+            batch = uncached[start:start + COORDINATE_BATCH_SIZE]
+
+            url_query_string = urlencode(
+                {
+                    "where": " OR ".join(f"({self._address_query(address)})" for address in batch),
+                    "outFields": ",".join([*COORDINATE_SERVICE_LATLON, *ADDRESS_FIELDS]),
+                    "f": "json",
+                    "token": self.token,
+                }
+            )
+
+            # The OR'ed clauses are too long for a URL, so the batch is sent as a form body.
+            with self.metrics.span("coordinate_lookup_batch"):
+                success, result = self._query_feature_layer(url_query_string, post=True)
+
+            if not success:
+                logging.error(f"Error occurred when requesting feature layer: {str(result)}")
+                continue
+
+            for feature in result.get("features", []):
+                attributes = feature.get("attributes", {})
+                try:
+                    address = Address.create(*(attributes.get(field) for field in ADDRESS_FIELDS))
+                except (TypeError, ValueError):
+                    continue
+
+                # Keep the first feature of each address (like a single query does).
+                self._coordinate_cache.setdefault(address, (
+                    float(attributes.get(COORDINATE_SERVICE_LATLON[0], 0)),
+                    float(attributes.get(COORDINATE_SERVICE_LATLON[1], 0))
+                ))
+
+            for address in batch:
+                self._coordinate_cache.setdefault(address, (None, None))
+
+        return {address: self._coordinate_cache.get(address, (None, None)) for address in addresses}
+
     def _request_authentication_token(self) -> str:
         """
         Requests a new token for ArcGIS authentication.
@@ -64,7 +220,7 @@ class CoordinateService:
         }
 
         try:
-            result = self.requests_session.post(
+            result = self.token_session.post(
                 COORDINATE_SERVICE_AUTHENTICATION["url"], request_data
             )
 
@@ -101,13 +257,7 @@ class CoordinateService:
         :rtype: float | None, float | None
         """
 
-        query_string = f"postcode='{zip_code}' AND huisnummer='{house_number}'"
-
-        # Query on suffix if available
-        if suffix:
-            query_string = f"{query_string} AND huisext='{suffix}'"
-        else:
-            query_string = f"{query_string} AND huisext IS NULL"
+        query_string = self._address_query(Address(zip_code, house_number, suffix))
 
         url_query_string = urlencode(
             {
@@ -142,26 +292,60 @@ class CoordinateService:
         return None, None
 
     @staticmethod
-    def _extract_form_address(form: Form) -> dict:
-        regex = r"^(\d{4}[A-Z]{2})(\d+)(?:_(.+))?$"
-        key = get_from_path(form.to_dict(), COORDINATE_SERVICE_KEYFIELD)
-        
-        if not key:
-            key = get_from_path(form.to_dict(), COORDINATE_SERVICE_KEYFIELD_FALLBACK)
+    def extract_form_address(form: Form) -> Optional[Address]:
+        """
+        Extracts the address of a form from its key field (or fallback key field).
 
-        result = re.search(regex, key)
+        :param form: The form to extract the address from.
+        :type form: Form
 
-        return {
-            "zip_code": result.group(1),
-            "house_number": result.group(2),
-            "suffix": result.group(3)
-        }
+        :return: The address of the form, or `None` if the form has no valid address key.
+        :rtype: Address | None
+        """
+
+        key = CoordinateService._get_form_address_key(form)
+
+        address = parse_address(key)
+        if not address:
+            logging.warning(f"Form has no valid address key: '{key}'")
+
+        return address
+
+    @staticmethod
+    def _get_form_address_key(form: Form):
+        return form.get(COORDINATE_SERVICE_KEYFIELD) or form.get(COORDINATE_SERVICE_KEYFIELD_FALLBACK)
 
-    def _query_feature_layer(self, url_query_string):
+    @staticmethod
+    def _address_query(address: Address) -> str:
+        query_string = f"postcode='{_escape(address.zip_code)}' AND huisnummer='{_escape(address.house_number)}'"
+
+        # Query on suffix if available (suffixes are normalized to upper case)
+        if address.suffix:
+            query_string = f"{query_string} AND UPPER(huisext)='{_escape(address.suffix)}'"
+        else:
+            query_string = f"{query_string} AND huisext IS NULL"
+
+        return query_string
+
+    def _query_feature_layer(self, url_query_string, post=False):
         try:
-            url = f"{COORDINATE_SERVICE}/query?{url_query_string}"
-            data = self.requests_session.get(url).json()
+            if post:
+                response = self.requests_session.post(
+                    f"{COORDINATE_SERVICE}/query",
+                    data=url_query_string,
+                    headers={"Content-Type": "application/x-www-form-urlencoded"}
+                )
+            else:
+                response = self.requests_session.get(f"{COORDINATE_SERVICE}/query?{url_query_string}")
+            self.metrics.increment("coordinate_query_retries", get_retry_count(response))
+            self.metrics.increment("coordinate_bytes_transferred", len(response.content))
+            data = response.json()
         except (ConnectionError, HTTPError, JSONDecodeError) as exception:
             return False, str(exception)
         else:
             return True, data
+
+
+def _escape(value: str) -> str:
+    # Quotes are escaped by doubling them in feature layer queries.
+    return str(value).replace("'", "''")
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from collections import Counter
+from config import IMAGE_STORE_BUCKET
+from constant import DEAD_LETTER_PATH
+from datetime import datetime, timezone
+from form_object import Form
+
+
+class DeadLetterService:
+    """
+    This class records forms that could not be published, so they can be replayed later.
+
+    Records are kept per form: one object per form under `{prefix}/` in storage, which is overwritten when the
+    form fails again. When a local path is specified (or set in the `DEAD_LETTER_LOCAL_PATH` environment variable)
+    records are appended to a local JSON lines file instead, where the lines of a form are merged when read.
+    Forms that were moved to the exhausted log (`{prefix}_exhausted`) are not recorded again.
+
+    Record syntax: {"bucket": {bucket}, "blob": {form blob}, "reason": {reason},
+        "attempt_count": {attempts}, "recorded_at": {RFC3339 timestamp}}
+    """
+
+    def __init__(self, storage_client=None, bucket_name: str = IMAGE_STORE_BUCKET,
+                 prefix: str = DEAD_LETTER_PATH, local_path: str = None):
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.local_path = local_path or os.environ.get("DEAD_LETTER_LOCAL_PATH")
+
+    @property
+    def exhausted(self):
+        """
+        The log of the forms that reached the maximum amount of attempts.
+        """
+
+        return DeadLetterService(
+            self.storage_client,
+            self.bucket_name,
+            f"{self.prefix}_exhausted",
+            f"{self.local_path}.exhausted" if self.local_path else None
+        )
+
+    def record(self, form: Form, reason: str, attempt_count: int = 1):
+        """
+        Records a failed form, unless it is in the exhausted log.
+
+        :param form: The form that failed.
+        :type form: Form
+        :param reason: Why the form failed.
+        :type reason: str
+        :param attempt_count: The amount of attempts done for this form.
+        :type attempt_count: int
+        """
+
+        if not form.source_name:
+            logging.error(f"Form has no source blob, can not record it: {reason}")
+            return
+
+        record = {
+            "bucket": form.source_bucket,
+            "blob": form.source_name,
+            "reason": reason,
+            "attempt_count": attempt_count,
+        }
+
+        if self.exhausted.contains(record):
+            logging.info(f"Failed form '{form.source_name}' is exhausted, not recording it again: {reason}")
+            return
+
+        self.append(record)
+
+    def append(self, record: dict):
+        """
+        Writes a record to the log. A record of the same form is replaced (keeping the highest attempt count).
+
+        :param record: The record to write.
+        :type record: dict
+        """
+
+        record = {**record, "recorded_at": datetime.now(timezone.utc).isoformat()}
+        logging.warning(f"Recording failed form '{record['blob']}': {record['reason']}")
+
+        if self.local_path:
+            with open(self.local_path, "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+            return
+
+        record_blob = self.storage_client.bucket(self.bucket_name).get_blob(self._get_record_name(record))
+        if record_blob:
+            previous_record = json.loads(record_blob.download_as_text())
+            record["attempt_count"] = max(record["attempt_count"], previous_record.get("attempt_count", 1))
+        else:
+            record_blob = self.storage_client.bucket(self.bucket_name).blob(self._get_record_name(record))
+
+        record_blob.upload_from_string(json.dumps(record), content_type="application/json")
+
+    def contains(self, record: dict) -> bool:
+        """
+        Checks if the log has a record of the same form.
+
+        :param record: The record to look for.
+        :type record: dict
+
+        :return: `True` if the form is recorded, `False` otherwise.
+        :rtype: bool
+        """
+
+        if self.local_path:
+            if not os.path.exists(self.local_path):
+                return False
+
+            key = _get_record_key(record)
+            with open(self.local_path) as log_file:
+                return any(line.strip() and _get_record_key(json.loads(line)) == key for line in log_file)
+
+        return self.storage_client.bucket(self.bucket_name).get_blob(self._get_record_name(record)) is not None
+
+    def drain(self, replay, batch_size: int = 100, max_batches: int = 0, max_attempts: int = 5) -> dict:
+        """
+        Replays the recorded forms in batches.
+
+        Replayed forms are removed from the log. Failed forms are recorded again with an
+        increased attempt count, unless they reached `max_attempts`: these are moved to `{prefix}_exhausted`.
+        The records of a batch are only removed after all of them are replayed, recorded again or moved,
+        so an interrupted drain does not lose records (it can replay a form twice instead).
+        Records that are written during the drain (including failed forms) are left for the next drain.
+
+        :param replay: Function that replays a record, returns `True` on success, `False` otherwise.
+            Exceptions count as a failure.
+        :type replay: callable
+        :param batch_size: The amount of records per batch.
+        :type batch_size: int
+        :param max_batches: The maximum amount of batches (0 for no maximum).
+        :type max_batches: int
+        :param max_attempts: The maximum amount of attempts per form.
+        :type max_attempts: int
+
+        :return: The counters of the replay.
+        :rtype: dict
+        """
+
+        result = {
+            "replayed_form_count": 0,
+            "failed_form_count": 0,
+            "exhausted_form_count": 0,
+        }
+
+        drain_start = datetime.now(timezone.utc)
+
+        batch_count = 0
+        while not max_batches or batch_count < max_batches:
+            batch = self._read_batch(batch_size, drain_start)
+            if not batch:
+                break
+
+            batch_count += 1
+            logging.info(f"Replaying batch {batch_count} ({len(batch)} forms).")
+
+            for _, record in batch:
+                try:
+                    replayed = replay(record)
+                except Exception as exception:
+                    logging.error(f"Could not replay form '{record.get('blob')}': {str(exception)}")
+                    replayed = False
+
+                if replayed:
+                    result["replayed_form_count"] += 1
+                    continue
+
+                record = {**record, "attempt_count": record.get("attempt_count", 1) + 1}
+                if record["attempt_count"] >= max_attempts:
+                    result["exhausted_form_count"] += 1
+                    self.exhausted.append(record)
+                else:
+                    result["failed_form_count"] += 1
+                    self.append(record)
+
+            self._remove([entry for entry, _ in batch])
+
+        return result
+
+    def _read_batch(self, batch_size: int, before: datetime) -> list:
+        """
+        Returns records of the log (and their log entry), that were written before the specified time.
+        The records are not removed from the log (see `_remove`).
+        """
+
+        if self.local_path:
+            if not os.path.exists(self.local_path):
+                return []
+
+            # The lines of a form are merged, the latest line with the highest attempt count.
+            entries = {}
+            with open(self.local_path) as log_file:
+                for line in log_file:
+                    if not line.strip():
+                        continue
+
+                    record = json.loads(line)
+                    if record["recorded_at"] >= before.isoformat():
+                        continue
+
+                    key = _get_record_key(record)
+                    if key not in entries and len(entries) >= batch_size:
+                        continue
+
+                    lines, previous_record = entries.get(key, ([], {}))
+                    attempt_count = max(record.get("attempt_count", 1), previous_record.get("attempt_count", 1))
+                    entries[key] = ([*lines, line], {**record, "attempt_count": attempt_count})
+
+            return list(entries.values())
+
+        # Records that are written during the drain have a newer update time.
+        batch = []
+        record_blobs = self.storage_client.list_blobs(bucket_or_name=self.bucket_name, prefix=f"{self.prefix}/")
+        for record_blob in record_blobs:
+            if record_blob.updated >= before:
+                continue
+
+            batch.append((record_blob, json.loads(record_blob.download_as_text())))
+            if len(batch) >= batch_size:
+                break
+
+        return batch
+
+    def _remove(self, entries: list):
+        """
+        Removes log entries (see `_read_batch`): their lines of the local log (in one rewrite),
+        or their storage objects unless these were written again meanwhile.
+        """
+
+        if not self.local_path:
+            from google.api_core import exceptions
+
+            for record_blob in entries:
+                try:
+                    record_blob.delete(if_generation_match=record_blob.generation)
+                except (exceptions.NotFound, exceptions.PreconditionFailed):
+                    pass
+
+            return
+
+        removed_lines = Counter(line for lines in entries for line in lines)
+
+        remaining_lines = []
+        with open(self.local_path) as log_file:
+            for line in log_file:
+                if removed_lines[line] > 0:
+                    removed_lines[line] -= 1
+                elif line.strip():
+                    remaining_lines.append(line)
+
+        # The remaining records are written to a new log, which replaces the current one.
+        remaining_path = f"{self.local_path}.{uuid.uuid4().hex}"
+        with open(remaining_path, "w") as log_file:
+            log_file.writelines(remaining_lines)
+        os.replace(remaining_path, self.local_path)
+
+    def _get_record_name(self, record: dict) -> str:
+        return f"{self.prefix}/{_get_record_key(record)}.json"
+
+
+def _get_record_key(record: dict) -> str:
+    # A form is identified by its blob, the key is hashed since blob names contain slashes.
+    return hashlib.sha256(f"{record['bucket']}/{record['blob']}".encode("utf-8")).hexdigest()
@@ -16,12 +16,14 @@ from constant import (
     IMAGE_FILE_EXTENSIONS
 )
 
-from typing import Optional
-from utils import get_from_path
-from google.cloud.storage.blob import Blob
+from typing import Optional, TYPE_CHECKING
+from utils import compile_path
 from os import path
 from urllib.parse import quote_plus
 
+if TYPE_CHECKING:
+    from google.cloud.storage.blob import Blob
+
 
 class Attachment:
     """
@@ -47,6 +49,10 @@ class Form:
 
         self._raw_data = data
 
+        # The blob the form was loaded from (if any), so it can be loaded again.
+        self.source_bucket = None
+        self.source_name = None
+
         self.attachment_bucket_base_path = (
             f"{IMAGE_STORE_PATH}/{provider_id}/{form_code}/{ds_row_id}"
         )
@@ -60,7 +66,7 @@ class Form:
         )
 
     def get(self, var_path: str):
-        return get_from_path(self._raw_data, var_path)
+        return compile_path(var_path).get(self._raw_data)
 
     def to_compiled_data(self) -> dict:
         """
@@ -107,7 +113,7 @@ class Form:
         return attachments
 
     @staticmethod
-    def from_blob(blob: Blob):
+    def from_blob(blob: "Blob"):
         # Check if blob is man-made folder (0 byte object)
         if blob.size:
             json_data = blob.download_as_text()
@@ -116,6 +122,8 @@ class Form:
             try:
                 form_data = json.loads(json_data)
                 form = Form(form_data)
+                form.source_bucket = blob.bucket.name if blob.bucket else None
+                form.source_name = blob.name
                 return form
             except (KeyError, json.decoder.JSONDecodeError) as exception:
                 logging.error(
@@ -1,11 +1,12 @@
 from typing import Optional
 from enum import Enum, unique
+from functools import lru_cache
 
 from config import (
     TOPIC_ROUTE_RULES as TOPIC_ROUTE_RULE_LIST
 )
 
-from utils import get_from_path
+from utils import compile_path
 
 
 @unique
@@ -28,13 +29,13 @@ class FormRule:
             rule_type_args: list,
             invert: bool = False,
     ):
-        self._target = target
+        self._target = compile_path(target)
         self._invert = invert
         self._rule_type = rule_type
         self._rule_type_args = rule_type_args
 
     def eval(self, form: dict) -> bool:
-        value = get_from_path(form, self._target)
+        value = self._target.get(form)
         return self._rule_type.eval([value, *self._rule_type_args]) ^ self._invert
 
 
@@ -72,4 +73,68 @@ def rule_from_dict(rule: dict) -> list:
     }
 
 
-TOPIC_ROUTE_RULES = [rule_from_dict(rule) for rule in TOPIC_ROUTE_RULE_LIST]
+def rule_alerts_from_dict(rules: list) -> list:
+    """
+    Creates the rules of a query, including their (optional) alert.
+
+    Alert syntax: {"message": {message}, "variables": {{name}: {path}}}
+        Every "{name}" in the message is replaced by the form's value at the variable's path.
+
+    :param rules: The rules to create.
+    :type rules: list[dict]
+
+    :return: The created rules.
+    :rtype: list[dict]
+    """
+
+    rule_alerts = []
+    for rule in rules:
+        rule_alert = rule_from_dict(rule)
+        rule_alert["alert"] = rule.get("alert")
+        rule_alerts.append(rule_alert)
+
+    return rule_alerts
+
+
+def is_passing_rules(data: dict, rules: list) -> (bool, Optional[str]):
+    """
+    Checks if the data passes any of the specified rules.
+
+    :param data: The data to check.
+    :type data: dict
+    :param rules: The rules (see `rule_alerts_from_dict`).
+    :type rules: list[dict]
+
+    :return: `True` if any rule passes, `False` otherwise.,
+        The alert message of the passing rule (if any).
+    :rtype: bool, str | None
+    """
+
+    for rule in rules:
+        if is_passing_rule(data, rule):
+            return True, _format_alert(data, rule.get("alert"))
+
+    return False, None
+
+
+def _format_alert(data: dict, alert: Optional[dict]) -> Optional[str]:
+    if not alert:
+        return None
+
+    message = alert.get("message", "")
+    for name, var_path in alert.get("variables", {}).items():
+        message = message.replace(f"{{{name}}}", str(compile_path(var_path).get(data)))
+
+    return message
+
+
+@lru_cache(maxsize=None)
+def get_topic_route_rules() -> list:
+    """
+    Returns the topic route rules, these are created on first use (instead of on import).
+
+    :return: The topic route rules.
+    :rtype: list[dict]
+    """
+
+    return [rule_from_dict(rule) for rule in TOPIC_ROUTE_RULE_LIST]
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+
+
+class Metrics:
+    """
+    This class collects per-invocation timings and counters.
+
+    Timings are recorded per stage (span name), counters are free-form
+    (bytes transferred, retries, cache hits, etc.).
+    When an OpenTelemetry tracer is given, every span is also exported as an OpenTelemetry span.
+    """
+
+    enabled = True
+
+    def __init__(self, name: str, tracer=None):
+        self.name = name
+        self._tracer = tracer
+        self._start_time = time.perf_counter()
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str):
+        """
+        Times the enclosed block and adds it to the timings of the specified stage.
+
+        :param name: The name of the stage.
+        :type name: str
+        """
+
+        otel_span = self._tracer.start_as_current_span(name) if self._tracer else nullcontext()
+
+        with otel_span:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._add_timing(name, time.perf_counter() - start)
+
+    def increment(self, counter: str, value: int = 1):
+        """
+        Increments the specified counter.
+
+        :param counter: The name of the counter.
+        :type counter: str
+        :param value: The value to increment the counter with.
+        :type value: int
+        """
+
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def summary(self) -> dict:
+        """
+        Returns a structured summary of this invocation's metrics.
+
+        :return: The invocation name, total duration, per-stage timings and counters.
+        :rtype: dict
+        """
+
+        return {
+            "invocation": self.name,
+            "duration_ms": round((time.perf_counter() - self._start_time) * 1000, 3),
+            "stages": {
+                name: {
+                    "count": timing["count"],
+                    "total_ms": round(timing["total"] * 1000, 3),
+                    "max_ms": round(timing["max"] * 1000, 3),
+                }
+                for name, timing in self._timings.items()
+            },
+            "counters": dict(self._counters),
+        }
+
+    def log_summary(self):
+        """
+        Logs the summary of this invocation's metrics as a single JSON line.
+        """
+
+        logging.info(json.dumps({"metrics": self.summary()}))
+
+    def _add_timing(self, name: str, duration: float):
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += duration
+            timing["max"] = max(timing["max"], duration)
+
+
+class NullMetrics(Metrics):
+    """
+    No-op metrics, used when instrumentation is disabled.
+    """
+
+    enabled = False
+
+    def __init__(self, name: str = "", tracer=None):
+        self.name = name
+
+    def span(self, name: str):
+        return _NULL_CONTEXT
+
+    def increment(self, counter: str, value: int = 1):
+        pass
+
+    def summary(self) -> dict:
+        return {}
+
+    def log_summary(self):
+        pass
+
+
+_NULL_CONTEXT = nullcontext()
+
+NULL_METRICS = NullMetrics()
+
+
+def get_metrics(name: str, enabled: bool = None) -> Metrics:
+    """
+    Returns a metrics collector for an invocation.
+
+    Instrumentation is enabled by `enabled`, or else by the `ENABLE_METRICS` environment variable.
+    Setting the `METRICS_EXPORTER` environment variable to `opentelemetry` also exports all
+    spans through the globally configured OpenTelemetry tracer provider.
+
+    :param name: The name of the invocation (usually the function name).
+    :type name: str
+    :param enabled: Whether instrumentation is enabled, overrides the environment.
+    :type enabled: bool
+
+    :return: A metrics collector, or a no-op collector when disabled.
+    :rtype: Metrics
+    """
+
+    if enabled is None:
+        enabled = os.environ.get("ENABLE_METRICS", "").lower() in ("1", "true", "yes")
+
+    if not enabled:
+        return NULL_METRICS
+
+    tracer = None
+    if os.environ.get("METRICS_EXPORTER", "").lower() == "opentelemetry":
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            logging.warning("OpenTelemetry is not installed, metrics will not be exported.")
+        else:
+            tracer = trace.get_tracer(name)
+
+    return Metrics(name, tracer=tracer)
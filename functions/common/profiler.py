@@ -0,0 +1,338 @@
+import cProfile
+import functools
+import json
+import pstats
+import re
+import sys
+import threading
+import time
+
+from collections import Counter
+
+# Built-in functions have no file in cProfile ("~"), their module is in their name:
+# "<built-in method time.sleep>" or "<method 'acquire' of '_thread.lock' objects>".
+BUILTIN_NAME_REGEX = re.compile(r"^<(?:built-in method (\S+?)(?: of .*)?|method '\w+' of '([\w.]+)' objects)>$")
+
+
+class Profiler:
+    """
+    This class profiles a (maintenance) run in place.
+
+    Two modes are supported:
+    - `cprofile`: deterministic profiling of every function call with cProfile.
+    - `sampling`: samples the stack of the profiled thread every `interval` seconds,
+        which has a lower overhead on long runs.
+
+    Work in other threads is included as well, so its time is summed over the threads: `sampling` samples the
+    threads that are started while profiling, `cprofile` profiles the calls wrapped with `profile_call`.
+    """
+
+    MODES = ("cprofile", "sampling")
+
+    def __init__(self, mode: str = "cprofile", interval: float = 0.01, top: int = 25):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown profiling mode '{mode}', expected one of {self.MODES}")
+
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+
+        self._profile = None
+        self._thread_id = None
+        self._thread_profiles = []
+        self._thread_profiles_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self._sampler = None
+        self._stop_event = threading.Event()
+        self._samples = Counter()
+        self._leaf_samples = Counter()
+        self._sample_count = 0
+        self._start_time = None
+        self._duration = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        global _active_profiler
+
+        self._start_time = time.perf_counter()
+        self._thread_id = threading.get_ident()
+
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            _active_profiler = self
+        else:
+            ignored_thread_ids = {thread_id for thread_id in sys._current_frames() if thread_id != self._thread_id}
+            self._sampler = threading.Thread(target=self._sample, args=(self._thread_id, ignored_thread_ids),
+                                             daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        global _active_profiler
+
+        if self._profile:
+            self._profile.disable()
+            if _active_profiler is self:
+                _active_profiler = None
+        if self._sampler:
+            self._stop_event.set()
+            self._sampler.join()
+
+        self._duration = time.perf_counter() - self._start_time
+
+    def result(self) -> dict:
+        """
+        Returns the aggregated profile of the run.
+
+        :return: The profiling mode, duration, the top functions and the time per module.
+        :rtype: dict
+        """
+
+        result = {
+            "mode": self.mode,
+            "duration_s": round(self._duration or 0, 3),
+        }
+
+        if self.mode == "cprofile":
+            functions, modules = self._aggregate_cprofile()
+        else:
+            functions, modules = self._aggregate_samples()
+            result["interval_s"] = self.interval
+            result["sample_count"] = self._sample_count
+
+        result["top_functions"] = functions
+        result["time_by_module"] = modules
+
+        return result
+
+    def upload(self, storage_client, bucket_name: str, blob_name: str):
+        """
+        Writes the aggregated profile to a storage object.
+
+        :param storage_client: The storage client to upload with.
+        :type storage_client: google.cloud.storage.Client
+        :param bucket_name: The name of the bucket to write to.
+        :type bucket_name: str
+        :param blob_name: The name of the object to write.
+        :type blob_name: str
+        """
+
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+        blob.upload_from_string(json.dumps(self.result()), content_type="application/json")
+
+    def _call_profiled(self, function, *args, **kwargs):
+        # The profile of a thread is only enabled during the call, so it never outlives the run.
+        profile = getattr(self._thread_local, "profile", None)
+        if profile is None:
+            profile = self._thread_local.profile = cProfile.Profile()
+            with self._thread_profiles_lock:
+                self._thread_profiles.append(profile)
+
+        profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+
+    def _sample(self, target_thread_id, ignored_thread_ids):
+        ignored_thread_ids = {*ignored_thread_ids, threading.get_ident()}
+
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if target_thread_id not in frames:
+                break
+
+            # A tick is a sample of the profiled thread, the threads it started are sampled along with it.
+            self._sample_count += 1
+            for thread_id, frame in frames.items():
+                if thread_id not in ignored_thread_ids:
+                    self._sample_stack(frame)
+
+    def _sample_stack(self, frame):
+        self._leaf_samples[frame.f_code.co_filename] += 1
+
+        # Every function on the stack is counted once per sample (cumulative time).
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key not in seen:
+                seen.add(key)
+                self._samples[key] += 1
+            frame = frame.f_back
+
+    def _aggregate_cprofile(self) -> (list, dict):
+        stats = pstats.Stats(self._profile)
+        for thread_profile in self._thread_profiles:
+            stats.add(thread_profile)
+
+        functions = []
+        modules = Counter()
+        for (filename, line, name), (_, call_count, total_time, cumulative_time, _) in stats.stats.items():
+            module = _module_name(filename, name)
+            functions.append({
+                "function": f"{module}:{line}({name})",
+                "calls": call_count,
+                "total_time_s": total_time,
+                "cumulative_time_s": cumulative_time,
+            })
+            modules[module] += total_time
+
+        functions.sort(key=lambda function: function["cumulative_time_s"], reverse=True)
+
+        for function in functions:
+            function["total_time_s"] = round(function["total_time_s"], 6)
+            function["cumulative_time_s"] = round(function["cumulative_time_s"], 6)
+
+        return functions[:self.top], _round_modules(modules, self.top)
+
+    def _aggregate_samples(self) -> (list, dict):
+        # Samples are converted to time by their share of the run's duration.
+        seconds_per_sample = (self._duration or 0) / self._sample_count if self._sample_count else 0
+
+        functions = [
+            {
+                "function": f"{_module_name(filename)}:{line}({name})",
+                "samples": count,
+                "cumulative_time_s": count * seconds_per_sample,
+            }
+            for (filename, line, name), count in self._samples.most_common(self.top)
+        ]
+
+        for function in functions:
+            function["cumulative_time_s"] = round(function["cumulative_time_s"], 6)
+
+        # Only the innermost frame of a sample is attributed to a module.
+        modules = Counter()
+        for filename, count in self._leaf_samples.items():
+            modules[_module_name(filename)] += count * seconds_per_sample
+
+        return functions, _round_modules(modules, self.top)
+
+
+# The `cprofile` profiler that is running, used by `profile_call`.
+_active_profiler = None
+
+
+def profile_call(function):
+    """
+    Wraps a function that is called in worker threads, so its calls are included in a running `cprofile` profile.
+    (A cProfile profile only sees the thread it is enabled in.)
+
+    :param function: The function to wrap.
+    :type function: callable
+
+    :return: The wrapped function.
+    :rtype: callable
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = _active_profiler
+        if not profiler or threading.get_ident() == profiler._thread_id:
+            return function(*args, **kwargs)
+
+        return profiler._call_profiled(function, *args, **kwargs)
+
+    return wrapper
+
+
+def _module_name(filename: str, function_name: str = "") -> str:
+    if filename == "~":
+        return _builtin_module_name(function_name)
+    if filename.startswith("<"):
+        return filename
+
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path):
+            filename = filename[len(path):].lstrip("/\\")
+            break
+
+    return filename.rsplit(".", 1)[0].replace("/", ".").replace("\\", ".").lstrip(".")
+
+
+def _builtin_module_name(function_name: str) -> str:
+    match = BUILTIN_NAME_REGEX.match(function_name)
+    qualified_name = match and (match.group(1) or match.group(2))
+    if not qualified_name or "." not in qualified_name:
+        return "builtins"
+
+    return qualified_name.rsplit(".", 1)[0]
+
+
+def _round_modules(modules: Counter, top: int) -> dict:
+    return {module: round(seconds, 6) for module, seconds in modules.most_common(top)}
+
+
+def create_profiler(options):
+    """
+    Creates a profiler according to the specified profiling options (see `profile_from_arguments`).
+
+    :param options: The profiling options, `true` for the default options.
+    :type options: dict | bool
+
+    :raises ValueError: If the options are invalid.
+
+    :return: The profiler, or `None` when profiling is disabled.
+    :rtype: Profiler | None
+    """
+
+    if not options:
+        return None
+
+    if not isinstance(options, dict):
+        options = {}
+
+    try:
+        interval = float(options.get("interval", 0.01))
+        top = int(options.get("top", 25))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid profiling options: {json.dumps(options)}")
+
+    return Profiler(mode=options.get("mode", "cprofile"), interval=interval, top=top)
+
+
+def profile_from_arguments(options, storage_client, run, *args, **kwargs):
+    """
+    Calls `run` with the specified arguments, profiled according to the specified profiling options.
+
+    Profiling options (`true` for the default options):
+    - mode: `cprofile` or `sampling` (default: `cprofile`).
+    - interval: The sampling interval in seconds (default: 0.01).
+    - top: The amount of functions/modules to report (default: 25).
+    - output_bucket, output_blob: When specified, the profile is written to this storage object
+        instead of being returned.
+
+    The options are validated before `run` is called, use `create_profiler` to validate them up front.
+
+    :param options: The profiling options, profiling is disabled when empty.
+    :type options: dict | bool
+    :param storage_client: The storage client used to write the profile.
+    :type storage_client: google.cloud.storage.Client
+    :param run: The function to profile.
+    :type run: callable
+
+    :raises ValueError: If the profiling options are invalid.
+
+    :return: The result of `run`., The profile (or its location when written to storage), or `None`.
+    :rtype: any, dict | None
+    """
+
+    profiler = create_profiler(options)
+    if not profiler:
+        return run(*args, **kwargs), None
+
+    with profiler:
+        result = run(*args, **kwargs)
+
+    if isinstance(options, dict) and options.get("output_bucket") and options.get("output_blob"):
+        profiler.upload(storage_client, options["output_bucket"], options["output_blob"])
+        return result, {"location": f"gs://{options['output_bucket']}/{options['output_blob']}"}
+
+    return result, profiler.result()
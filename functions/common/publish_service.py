@@ -1,25 +1,44 @@
 import json
 import logging
 
-from gobits import Gobits
+from concurrency_limiter import get_limiter
 from coordinate_service import CoordinateService
+from dead_letter_service import DeadLetterService
 from form_object import Form
-from google.cloud.pubsub_v1 import PublisherClient
-from retry import retry
+from metrics import Metrics, NULL_METRICS
 from form_rule import (
-    TOPIC_ROUTE_RULES,
+    get_topic_route_rules,
     is_passing_rule
 )
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from gobits import Gobits
 
 
 class PublishService:
-    def __init__(self, topic_name_fallback, **kwargs):
+    def __init__(self, topic_name_fallback, metrics: Metrics = NULL_METRICS,
+                 dead_letter_service: DeadLetterService = None, **kwargs):
+        from google.cloud.pubsub_v1 import PublisherClient
+
         self._publisher = PublisherClient()
         self._topic_name_fallback = topic_name_fallback
-        self.coordinate_service = CoordinateService(**kwargs)
+        self.metrics = metrics
+        self.dead_letter_service = dead_letter_service
+        self.limiter = get_limiter("publisher")
+        self.coordinate_service = CoordinateService(metrics=metrics, **kwargs)
+
+    def prefetch_coordinates(self, forms: list):
+        """
+        Looks up the coordinates of the specified forms together, before they are published one by one.
+
+        :param forms: The forms that will be published.
+        :type forms: list[Form]
+        """
+
+        self.coordinate_service.prefetch_form_coordinates(forms)
 
-    @retry(tries=5, delay=5, backoff=2, logger=None)
-    def publish_form(self, form: Form, metadata: Gobits):
+    def publish_form(self, form: Form, metadata: "Gobits") -> bool:
         """
         Publishes a form object to topic.
 
@@ -32,8 +51,34 @@ class PublishService:
         :type form: Form
         :param metadata: Metadata of cloud function trigger event.
         :type metadata: Gobits
+
+        :return: `True` if the form is published, `False` if it is recorded as failed.
+        :rtype: bool
         """
 
+        from retry.api import retry_call
+
+        try:
+            published = retry_call(
+                self._publish_form, fargs=[form, metadata], tries=5, delay=5, backoff=2, logger=None
+            )
+        except Exception as exception:
+            if not self.dead_letter_service:
+                raise
+
+            self.metrics.increment("dead_lettered_forms")
+            self.dead_letter_service.record(form, f"publish_failed: {exception}")
+            return False
+
+        if not published and self.dead_letter_service:
+            self.metrics.increment("dead_lettered_forms")
+            self.dead_letter_service.record(form, "coordinate_lookup_failed")
+
+        return published
+
+    def _publish_form(self, form: Form, metadata: "Gobits") -> bool:
+        self.metrics.increment("publish_attempts")
+
         # Converting/downloading the coordinates for this form.
         data = self.coordinate_service.form_to_geojson(form)
         if data:
@@ -43,19 +88,27 @@ class PublishService:
                 "gobits": [metadata.to_json()]
             }
 
-            raw_form_data = form.to_dict()
-            topic_name = self._topic_name_fallback
-            for route_rule in TOPIC_ROUTE_RULES:
-                if is_passing_rule(raw_form_data, route_rule):
-                    topic_name = route_rule["data"]["topic_name"]
+            with self.metrics.span("route_evaluation"):
+                raw_form_data = form.to_dict()
+                topic_name = self._topic_name_fallback
+                for route_rule in get_topic_route_rules():
+                    if is_passing_rule(raw_form_data, route_rule):
+                        topic_name = route_rule["data"]["topic_name"]
 
             logging.info(f"Publishing form to ArcGIS interface ({topic_name}).")
 
-            future = self._publisher.publish(
-                topic_name, bytes(json.dumps(
-                    message_to_publish).encode("utf-8"))
-            )
+            message_data = json.dumps(message_to_publish).encode("utf-8")
+
+            with self.metrics.span("publish"), self.limiter.request():
+                future = self._publisher.publish(topic_name, message_data)
+                message_id = future.result()
+
+            self.metrics.increment("published_forms")
+            self.metrics.increment("publish_bytes_transferred", len(message_data))
+
+            logging.info(f"Published form to ArcGIS interface ({topic_name}) with ID {message_id}")
+            return True
 
-            logging.info(f"Published form to ArcGIS interface ({topic_name}) with ID {future.result()}")
-        else:
-            logging.error("Could not get data to send to ArcGIS, skipping...")
+        self.metrics.increment("skipped_forms")
+        logging.error("Could not get data to send to ArcGIS, skipping...")
+        return False
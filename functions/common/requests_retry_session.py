@@ -1,14 +1,31 @@
 import requests
+import time
 
+from concurrency_limiter import is_overload_status
+from email.utils import parsedate_to_datetime
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+# The methods of which a status is retried by default (like urllib3), other methods are not idempotent.
+IDEMPOTENT_METHODS = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE"])
 
-def get_requests_session(retries=6, backoff=10, status_forcelist=(404, 500, 502, 503, 504)):
+# The statuses of which the `Retry-After` header is respected (like urllib3).
+RETRY_AFTER_STATUS_CODES = frozenset([413, 429, 503])
+
+
+def get_requests_session(
+        retries=6, backoff=10, status_forcelist=(404, 500, 502, 503, 504), limiter=None, retry_methods=None
+):
     """
     Returns a requests session with retry enabled.
+
+    When a concurrency limiter is specified, every attempt goes through the limiter (see `LimitedSession`).
+    The statuses of other methods than `retry_methods` (by default the idempotent methods) are not retried.
     """
 
+    if limiter:
+        return LimitedSession(limiter, retries, backoff, status_forcelist, retry_methods or IDEMPOTENT_METHODS)
+
     session = requests.Session()
     retry = Retry(
         total=retries,
@@ -23,3 +40,96 @@ def get_requests_session(retries=6, backoff=10, status_forcelist=(404, 500, 502,
     session.mount('https://', adapter)
 
     return session
+
+
+class LimitedSession(requests.Session):
+    """
+    A requests session of which every attempt goes through a concurrency limiter (see `AdaptiveLimiter`).
+
+    The retries are done by the session itself instead of by urllib3, so the limiter gets a sample of
+    every attempt (a 429/5xx response or a connection error is an overload), and the limiter's slot is
+    released during the backoff. The backoff is the same as urllib3's, including the `Retry-After` header.
+    """
+
+    BACKOFF_MAX = 120
+
+    def __init__(self, limiter, retries=6, backoff=10, status_forcelist=(404, 500, 502, 503, 504),
+                 retry_methods=IDEMPOTENT_METHODS):
+        super().__init__()
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.status_forcelist = status_forcelist
+        self.retry_methods = frozenset(method.upper() for method in retry_methods)
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            response = None
+            try:
+                with self.limiter.request() as sample:
+                    response = super().request(method, url, *args, **kwargs)
+                    sample.overloaded = is_overload_status(response.status_code)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if (
+                        response.status_code not in self.status_forcelist
+                        or method.upper() not in self.retry_methods
+                        or attempt >= self.retries
+                ):
+                    # Read by `get_retry_count`.
+                    response.retry_count = attempt
+                    return response
+
+            attempt += 1
+            time.sleep(self._get_backoff_time(attempt, response))
+
+    def _get_backoff_time(self, attempt: int, response=None) -> float:
+        retry_after = _get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return retry_after
+
+        # The first retry is immediate, like urllib3.
+        if attempt <= 1:
+            return 0
+
+        return min(self.BACKOFF_MAX, self.backoff * (2 ** (attempt - 1)))
+
+
+def _get_retry_after(response):
+    # The header holds either seconds or an HTTP date.
+    if response.status_code not in RETRY_AFTER_STATUS_CODES:
+        return None
+
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    if retry_after.strip().isdigit():
+        return int(retry_after)
+
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_count(response) -> int:
+    """
+    Returns the amount of retries that were needed for the specified response.
+
+    :param response: The response to inspect.
+    :type response: requests.Response
+
+    :return: The amount of retries done by the session (or its retry adapter).
+    :rtype: int
+    """
+
+    retry_count = getattr(response, "retry_count", None)
+    if retry_count is not None:
+        return retry_count
+
+    retries = getattr(response.raw, "retries", None)
+    return len(retries.history) if retries else 0
@@ -0,0 +1,254 @@
+import itertools
+import json
+import logging
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from requests_retry_session import get_requests_session
+from constant import MAX_RANGE_COMBINATIONS, MAX_SHARD_MESSAGE_BYTES
+from typing import TYPE_CHECKING
+from utils import iter_ranges
+
+if TYPE_CHECKING:
+    from google.cloud.storage.blob import Blob
+
+# Format of a blob's creation time in its (JSON API) properties.
+TIME_CREATED_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+class ShardService:
+    """
+    This class splits a run into shards and fans them out to worker invocations.
+
+    Shard strategies:
+    - `hash`: The coordinator lists all blobs once and splits them on the CRC32 of their name.
+        Workers receive their blobs and do not list themselves. Shards that would exceed
+        `MAX_SHARD_MESSAGE_BYTES` are split into multiple shards.
+    - `prefix`: The storage suffixes (after unpacking ranges) are split over the shards.
+        Workers list only their own prefixes, the coordinator does not list at all.
+    """
+
+    STRATEGIES = ("hash", "prefix")
+
+    def __init__(self, shard_count: int, strategy: str = "hash"):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown shard strategy '{strategy}', expected one of {self.STRATEGIES}")
+        if shard_count < 1:
+            raise ValueError("The shard count must be at least 1")
+
+        self.shard_count = shard_count
+        self.strategy = strategy
+
+    def plan(self, arguments: dict, list_blobs) -> list:
+        """
+        Splits a run into the worker arguments of each shard.
+
+        :param arguments: The arguments of the run (without sharding options).
+        :type arguments: dict
+        :param list_blobs: Function that lists the blobs of the run (only used by the `hash` strategy).
+        :type list_blobs: callable
+
+        :return: The arguments of each non-empty shard.
+        :rtype: list[dict]
+        """
+
+        if self.strategy == "hash":
+            shards = [[] for _ in range(self.shard_count)]
+            for blob in list_blobs():
+                shards[self.shard_index(blob.name)].append(self.blob_to_dict(blob))
+            shards = [part for shard in shards for part in self._split_by_size(shard, arguments)]
+            key = "form_blobs"
+        else:
+            shards = [[] for _ in range(self.shard_count)]
+            storage_suffixes = arguments.get("form_storage_suffix", "")
+            if not isinstance(storage_suffixes, list):
+                storage_suffixes = [storage_suffixes]
+
+            suffixes = itertools.chain.from_iterable(
+                iter_ranges(storage_suffix, MAX_RANGE_COMBINATIONS) for storage_suffix in storage_suffixes
+            )
+            for index, suffix in enumerate(suffixes):
+                shards[index % self.shard_count].append(suffix)
+            key = "form_storage_suffix"
+
+        shards = [shard for shard in shards if shard]
+
+        return [
+            {
+                **arguments,
+                key: shard,
+                "shard": {"index": index, "count": len(shards)},
+            }
+            for index, shard in enumerate(shards)
+        ]
+
+    @staticmethod
+    def _split_by_size(blob_dicts: list, arguments: dict) -> list:
+        """
+        Splits the blobs of a shard into parts, of which the worker arguments fit in one message.
+        """
+
+        max_size = MAX_SHARD_MESSAGE_BYTES - len(json.dumps(arguments))
+
+        parts = [[]]
+        size = 0
+        for blob_dict in blob_dicts:
+            blob_size = len(json.dumps(blob_dict)) + 2  # Including the separator
+            if parts[-1] and size + blob_size > max_size:
+                parts.append([])
+                size = 0
+
+            parts[-1].append(blob_dict)
+            size += blob_size
+
+        return parts
+
+    def shard_index(self, blob_name: str) -> int:
+        """
+        Returns the shard of a blob, this is stable between invocations (unlike `hash`).
+        """
+
+        return zlib.crc32(blob_name.encode("utf-8")) % self.shard_count
+
+    @staticmethod
+    def dispatch_http(
+            url: str, worker_arguments: list, timeout: int = 540, max_workers: int = 16, deadline: float = None
+    ) -> list:
+        """
+        Invokes a worker over HTTP for each shard and waits for their results.
+        Shards that can not be started before the deadline are not sent, and count as failed.
+
+        :param url: The URL of the worker cloud function.
+        :type url: str
+        :param worker_arguments: The arguments of each shard.
+        :type worker_arguments: list[dict]
+        :param timeout: Request timeout in seconds.
+        :type timeout: int
+        :param max_workers: The maximum amount of concurrently running shards.
+        :type max_workers: int
+        :param deadline: The `time.monotonic()` time by which all shards must have returned.
+            The request timeout of a shard is shortened to it.
+        :type deadline: float
+
+        :return: The result of each shard (`None` for shards that failed).
+        :rtype: list[dict | None]
+        """
+
+        import google.auth.transport.requests
+        import google.oauth2.id_token
+
+        token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), url)
+        session = get_requests_session(retries=2, backoff=5, status_forcelist=(429, 500, 502, 503, 504))
+
+        def invoke(shard_arguments):
+            shard_timeout = timeout if deadline is None else min(timeout, deadline - time.monotonic())
+            if shard_timeout <= 0:
+                logging.error(f"Shard {shard_arguments['shard']['index']} was not sent before the deadline.")
+                return None
+
+            try:
+                response = session.post(
+                    url, json=shard_arguments, timeout=shard_timeout, headers={"Authorization": f"Bearer {token}"}
+                )
+                response.raise_for_status()
+                return response.json()
+            except Exception as exception:  # A failing shard must not fail the other shards
+                logging.error(f"Shard {shard_arguments['shard']['index']} failed: {str(exception)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(worker_arguments)))) as executor:
+            return list(executor.map(invoke, worker_arguments))
+
+    @staticmethod
+    def dispatch_pubsub(topic_name: str, worker_arguments: list) -> list:
+        """
+        Publishes a worker task on a topic for each shard.
+
+        :param topic_name: The (full) name of the topic the workers are subscribed to.
+        :type topic_name: str
+        :param worker_arguments: The arguments of each shard.
+        :type worker_arguments: list[dict]
+
+        :return: The message ID of each shard.
+        :rtype: list[str]
+        """
+
+        from google.cloud.pubsub_v1 import PublisherClient
+
+        publisher = PublisherClient()
+        futures = [
+            publisher.publish(topic_name, json.dumps(shard_arguments).encode("utf-8"))
+            for shard_arguments in worker_arguments
+        ]
+
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def merge_results(results: list) -> dict:
+        """
+        Merges the counters of the shard results into one report.
+
+        :param results: The result of each shard (`None` for shards that failed).
+        :type results: list[dict | None]
+
+        :return: The summed counters, and the amount of (failed) shards.
+        :rtype: dict
+        """
+
+        report = {
+            "shard_count": len(results),
+            "failed_shard_count": 0,
+        }
+
+        for result in results:
+            if result is None:
+                report["failed_shard_count"] += 1
+                continue
+
+            for key, value in result.items():
+                if isinstance(value, int) and not isinstance(value, bool):
+                    report[key] = report.get(key, 0) + value
+
+        return report
+
+    @staticmethod
+    def collect_reports(storage_client, bucket_name: str, prefix: str) -> dict:
+        """
+        Merges the shard reports that (Pub/Sub) workers wrote to storage.
+
+        :param storage_client: The storage client to use.
+        :type storage_client: google.cloud.storage.Client
+        :param bucket_name: The bucket of the shard reports.
+        :type bucket_name: str
+        :param prefix: The prefix of the shard reports.
+        :type prefix: str
+
+        :return: The merged report.
+        :rtype: dict
+        """
+
+        # The trailing slash keeps the reports of runs with a longer prefix (e.g. another run ID) out.
+        results = [
+            json.loads(blob.download_as_text())
+            for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=f"{prefix.rstrip('/')}/")
+        ]
+
+        return ShardService.merge_results(results)
+
+    @staticmethod
+    def blob_to_dict(blob: "Blob") -> dict:
+        return {
+            "name": blob.name,
+            "size": str(blob.size) if blob.size is not None else None,
+            "timeCreated": blob.time_created.strftime(TIME_CREATED_FORMAT) if blob.time_created else None,
+        }
+
+    @staticmethod
+    def blob_from_dict(bucket, data: dict) -> "Blob":
+        from google.cloud.storage.blob import Blob
+
+        # Same as how `list_blobs` creates its blobs from the listed properties.
+        blob = Blob(data["name"], bucket=bucket)
+        blob._set_properties(data)
+        return blob
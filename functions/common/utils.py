@@ -1,5 +1,19 @@
+import itertools
 import re
-from google.cloud import secretmanager
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+
+RANGE_REGEX = re.compile(r"\[(\d+)-(\d+)]")
+STRFTIME_CODE_REGEX = re.compile(r"%[-#_^0]?([a-zA-Z%])")
+
+# The smallest time unit of the `strftime` codes that change within a day, other codes change at most daily.
+STRFTIME_CODE_STEPS = {
+    **dict.fromkeys("HIklp", timedelta(hours=1)),
+    **dict.fromkeys("MR", timedelta(minutes=1)),
+    **dict.fromkeys("STXcrs", timedelta(seconds=1)),
+}
 
 
 def unpack_ranges(pattern) -> list:
@@ -23,31 +37,253 @@ def unpack_ranges(pattern) -> list:
     Example 3: 'A:[1-3] B:[1-3]'
     Result 3: ['A:1 B:1', 'A:1 B:2', 'A:2 B:1', 'A:2 B:2']
 
+    Use `iter_ranges` to unpack the combinations lazily.
+
     :param pattern: The pattern to unpack.
     :type pattern: str:
 
     :return: A list of all possible range combinations.
     :rtype: list[str]
     """
-    range_regex = r"\[(\d+)-(\d+)]"
-    match = re.search(range_regex, pattern)
 
-    suffixes = []
-    if match:
+    return list(iter_ranges(pattern))
+
+
+def iter_ranges(pattern, max_combinations: int = None):
+    """
+    Yields all possible range combinations one by one, in the same order as `unpack_ranges`.
+    Only the current combination is kept in memory.
+
+    :param pattern: The pattern to unpack (see `unpack_ranges`).
+    :type pattern: str
+    :param max_combinations: The maximum amount of combinations, `None` for no maximum.
+    :type max_combinations: int
+
+    :raises ValueError: If the pattern has more than `max_combinations` combinations.
+
+    :return: All possible range combinations.
+    :rtype: Iterator[str]
+    """
+
+    literals, ranges = _parse_ranges(pattern)
+
+    if max_combinations is not None:
+        combination_count = _count_combinations(ranges)
+        if combination_count > max_combinations:
+            raise ValueError(
+                f"Pattern '{pattern}' has {combination_count} combinations, the maximum is {max_combinations}"
+            )
+
+    return _iter_combinations(literals, ranges)
+
+
+def _parse_ranges(pattern) -> (list, list):
+    """
+    Splits a pattern into its literal parts and ranges.
+    There is always one more literal part than there are ranges.
+    """
+
+    literals = []
+    ranges = []
+
+    position = 0
+    for match in RANGE_REGEX.finditer(pattern):
         start = match.group(1)
         end = match.group(2)
-        justified = min(len(start), len(end))
 
-        for i in range(int(start), int(end)):
-            prefix = pattern[:match.start(0)]
-            suffix = pattern[match.end(0):]
-            number = str(i).rjust(justified, "0")
-            string = f"{prefix}{number}{suffix}"
-            suffixes.extend(unpack_ranges(string))
-    else:
-        suffixes.append(pattern)
+        literals.append(pattern[position:match.start(0)])
+        ranges.append((int(start), int(end), min(len(start), len(end))))
+        position = match.end(0)
+
+    literals.append(pattern[position:])
+
+    return literals, ranges
+
 
-    return suffixes
+def _count_combinations(ranges) -> int:
+    count = 1
+    for start, end, _ in ranges:
+        count *= max(end - start, 0)
+
+    return count
+
+
+def _iter_combinations(literals, ranges):
+    if not ranges:
+        yield literals[0]
+        return
+
+    numbers = [
+        [str(i).rjust(justified, "0") for i in range(start, end)]
+        for start, end, justified in ranges
+    ]
+
+    for combination in itertools.product(*numbers):
+        parts = [literals[0]]
+        for number, literal in zip(combination, literals[1:]):
+            parts.append(number)
+            parts.append(literal)
+
+        yield "".join(parts)
+
+
+def iter_time_partitions(start: datetime, end: datetime, partition_format: str):
+    """
+    Yields the distinct time partitions (formatted prefixes) from start to end, both included.
+
+    Example: from 2021-09-30 18:00 to 2021-10-01 06:00 with format `/%Y/%m/%d`
+        yields `/2021/09/30` and `/2021/10/01`.
+
+    :param start: The start of the time window.
+    :type start: datetime
+    :param end: The end of the time window.
+    :type end: datetime
+    :param partition_format: The `strftime` format of a partition.
+    :type partition_format: str
+
+    :raises ValueError: If the format has a unit smaller than a second (see `get_time_partition_step`).
+
+    :return: The time partitions, oldest first.
+    :rtype: generator[str]
+    """
+
+    # Stepping by the smallest unit of the format visits every partition, the end is added since
+    # a step can overshoot it.
+    step = get_time_partition_step(partition_format)
+
+    previous = None
+    current = start
+    while current < end + step:
+        partition = min(current, end).strftime(partition_format)
+        if partition != previous:
+            yield partition
+            previous = partition
+
+        current += step
+
+
+def get_time_partition_step(partition_format: str) -> timedelta:
+    """
+    Returns the smallest time unit of a time partition format, the step to visit all partitions with.
+
+    Example: `/%Y/%m/%d` steps by a day, `/%Y/%m/%d/%H%M` by a minute.
+
+    :param partition_format: The `strftime` format of a partition.
+    :type partition_format: str
+
+    :raises ValueError: If the format has a unit smaller than a second.
+
+    :return: The step.
+    :rtype: timedelta
+    """
+
+    codes = STRFTIME_CODE_REGEX.findall(partition_format)
+    if "f" in codes:
+        raise ValueError(f"Time partition format '{partition_format}' is finer than a second")
+
+    steps = [STRFTIME_CODE_STEPS[code] for code in codes if code in STRFTIME_CODE_STEPS]
+    return min(steps, default=timedelta(days=1))
+
+
+def intersect_prefixes(prefixes, other_prefixes) -> list:
+    """
+    Returns the prefixes that only match names matched by both a prefix of `prefixes`
+    and a prefix of `other_prefixes`.
+    Of two overlapping prefixes the longest one is the intersection, prefixes that do not overlap are left out.
+
+    Example: `["/2021/1", "/2021/2"]` and `["/2021/10/01", "/2021/2"]` intersect to `["/2021/10/01", "/2021/2"]`.
+
+    :param prefixes: The first prefixes.
+    :type prefixes: iterable[str]
+    :param other_prefixes: The second prefixes.
+    :type other_prefixes: iterable[str]
+
+    :return: The intersecting prefixes, sorted and without prefixes that are covered by another.
+    :rtype: list[str]
+    """
+
+    prefixes = sorted(set(prefixes))
+    prefix_set = set(prefixes)
+
+    result = set()
+    for other_prefix in set(other_prefixes):
+        # A prefix that is the start of the other prefix (shorter or equal).
+        if any(other_prefix[:length] in prefix_set for length in range(len(other_prefix) + 1)):
+            result.add(other_prefix)
+            continue
+
+        # The prefixes that start with the other prefix (longer), these are sorted next to each other.
+        index = bisect_left(prefixes, other_prefix)
+        while index < len(prefixes) and prefixes[index].startswith(other_prefix):
+            result.add(prefixes[index])
+            index += 1
+
+    # In sorted order a covering prefix comes right before the prefixes it covers.
+    intersection = []
+    for prefix in sorted(result):
+        if not intersection or not prefix.startswith(intersection[-1]):
+            intersection.append(prefix)
+
+    return intersection
+
+
+class CompiledPath:
+    """
+    This class represents a variable path that is parsed once, to be read from many dictionaries.
+    See `get_from_path` for the path syntax.
+    """
+
+    __slots__ = ("path", "_steps")
+
+    def __init__(self, var_path: str):
+        self.path = var_path
+
+        # Each key is stored with its list index (if it could be one), so reading does no parsing.
+        self._steps = tuple(
+            (key, int(key) if key.isdigit() else None) for key in var_path.split("/")
+        )
+
+    def get(self, dictionary: dict):
+        """
+        Returns the variable at this path of the specified dictionary.
+
+        :param dictionary: The dictionary to get the variable from.
+        :type dictionary: dict
+
+        :return: Returns a variable based on the specified dictionary and this path.
+        :rtype: int | float | bool | str | list | dict
+        """
+
+        current = dictionary
+        for key, index in self._steps:
+            if not current:
+                break
+            elif isinstance(current, dict):
+                current = current.get(key)
+            elif isinstance(current, list) and index is not None:
+                current = current[index] if index < len(current) else None
+            else:
+                current = None
+
+        return current
+
+    def __repr__(self):
+        return f"CompiledPath({self.path!r})"
+
+
+@lru_cache(maxsize=1024)
+def compile_path(var_path: str) -> CompiledPath:
+    """
+    Returns the compiled version of a variable path, compiled paths are cached.
+
+    :param var_path: The path of the variable.
+    :type var_path: str
+
+    :return: The compiled path.
+    :rtype: CompiledPath
+    """
+
+    return CompiledPath(var_path)
 
 
 def get_from_path(dictionary: dict, var_path: str):
@@ -69,6 +305,8 @@ def get_from_path(dictionary: dict, var_path: str):
     path `dict/foo` will return `bar`
     path `dict/list/1` will return `one`
 
+    When reading the same path from many dictionaries, use `compile_path` instead.
+
     :param dictionary: The dictionary to get the variable from.
     :type dictionary: dict
     :param var_path: The path of the variable in the dictionary.
@@ -78,24 +316,7 @@ def get_from_path(dictionary: dict, var_path: str):
     :rtype: int | float | bool | str | list | dict
     """
 
-    key_list = var_path.split("/")
-
-    current = dictionary
-    for key in key_list:
-        if not current:
-            break
-        elif isinstance(current, dict) and key in current:
-            current = current.get(key)
-        elif isinstance(current, list) and key.isdigit():
-            index = int(key)
-            if index >= 0 < len(current):
-                current = current[index]
-            else:
-                current = None
-        else:
-            current = None
-
-    return current
+    return compile_path(var_path).get(dictionary)
 
 
 def get_request_arguments(request):
@@ -128,6 +349,8 @@ def get_secret(project_id, secret_id):
     Returns a Secret Manager secret.
     """
 
+    from google.cloud import secretmanager
+
     client = secretmanager.SecretManagerServiceClient()
 
     secret_name = client.access_secret_version(
@@ -1,4 +1,5 @@
 import logging
+import os
 
 
 from config import (
@@ -8,9 +9,9 @@ from config import (
 
 from functions.common.form_object import Form
 from functions.common.attachment_service import AttachmentService
+from functions.common.dead_letter_service import DeadLetterService
+from functions.common.metrics import get_metrics
 from functions.common.publish_service import PublishService
-from gobits import Gobits
-from google.cloud import storage
 
 logging.basicConfig(level=logging.INFO)
 
@@ -37,19 +38,43 @@ def handler(data, context):
         f"Processing APPEEE form input from file gs://{bucket_name}/{filename}"
     )
 
+    metrics = get_metrics("get_images")
+    try:
+        _process_form(bucket_name, filename, context, metrics)
+    finally:
+        metrics.log_summary()
+
+
+def _process_form(bucket_name, filename, context, metrics):
+    """
+    Downloads the images of the specified form entry and publishes it on a topic.
+    """
+
+    from gobits import Gobits
+    from google.cloud import storage
+
     # Retrieve form entry
     storage_client = storage.Client()
-    entry_bucket = storage_client.get_bucket(bucket_name)
-    entry_blob = entry_bucket.get_blob(filename)
-    form = Form.from_blob(entry_blob)
+    with metrics.span("blob_fetch"):
+        entry_bucket = storage_client.get_bucket(bucket_name)
+        entry_blob = entry_bucket.get_blob(filename)
+        form = Form.from_blob(entry_blob)
 
     if not form:
         logging.warning(f"Could not get form object from {entry_blob.name}")
         return
 
     # Setup services
-    attachment_service = AttachmentService(storage_client)
-    publish_service = PublishService(TOPIC_NAME_FALLBACK)
+    attachment_service = AttachmentService(
+        storage_client,
+        metrics=metrics,
+        deduplicate=os.environ.get("ENABLE_ATTACHMENT_DEDUPLICATION", "").lower() in ("1", "true", "yes")
+    )
+    publish_service = PublishService(
+        TOPIC_NAME_FALLBACK,
+        metrics=metrics,
+        dead_letter_service=DeadLetterService(storage_client)
+    )
 
     # Download images
     logging.info("Downloading images")
@@ -1,21 +1,22 @@
 import json
 import logging
+import tempfile
 
 from config import (
     IMAGE_STORE_BUCKET,
     ENTRY_FILEPATH_PREFIX
 )
 
-from google.cloud import storage
-
-from functions.common.utils import get_request_arguments, unpack_ranges, get_from_path
+from functions.common.aggregation import aggregations_from_dict
+from functions.common.constant import MAX_RANGE_COMBINATIONS
+from functions.common.utils import get_request_arguments, iter_ranges, compile_path
 from functions.common.form_rule import rule_alerts_from_dict, is_passing_rules
-from functions.common.requests_retry_session import get_requests_session
+from functions.common.profiler import create_profiler, profile_from_arguments
 
 
 logging.basicConfig(level=logging.INFO)
 
-REQUEST_RETRY_SESSION = get_requests_session()
+OUTPUT_MODES = ("json", "ndjson")
 
 
 def handler(request):
@@ -30,8 +31,17 @@ def handler(request):
     # Initializing components
     arguments = get_request_arguments(request)
 
-    # Can be used to specify a sub directory.
-    form_storage_suffix = arguments.get("form_storage_suffix", "")
+    # Can be used to specify a sub directory (ranges are unpacked lazily).
+    try:
+        form_storage_suffixes = iter_ranges(arguments.get("form_storage_suffix", ""), MAX_RANGE_COMBINATIONS)
+    except ValueError as exception:
+        return json.dumps({"error": str(exception)}), 400
+
+    # Reject invalid profiling options, before doing any work.
+    try:
+        create_profiler(arguments.get("profiling"))
+    except ValueError as exception:
+        return json.dumps({"error": str(exception)}), 400
 
     query_rules = rule_alerts_from_dict(arguments.get("query", []))
 
@@ -39,50 +49,170 @@ def handler(request):
         "blob_name": "$BLOB_NAME"
     })
 
-    result_limit = arguments.get("result_limit", 0)
+    # Aggregate the matches during the scan, instead of returning them.
+    try:
+        aggregations = aggregations_from_dict(arguments.get("aggregate", []))
+    except ValueError as exception:
+        return json.dumps({"error": str(exception)}), 400
+
+    # Aggregations are over all matches, so the result limit does not apply to them.
+    result_limit = 0 if aggregations else arguments.get("result_limit", 0)
+
+    # Stream the matches as newline-delimited JSON, or write them to a storage object.
+    output_mode = arguments.get("output_mode", "json")
+    output_location = arguments.get("output_location")
+
+    if output_mode not in OUTPUT_MODES:
+        return json.dumps({"error": f"Unknown output mode '{output_mode}', expected one of {OUTPUT_MODES}"}), 400
+    if output_mode == "ndjson" and output_location:
+        return json.dumps({"error": "'output_location' can not be combined with the 'ndjson' output mode"}), 400
+    if aggregations and output_mode == "ndjson":
+        return json.dumps({"error": "'aggregate' can not be combined with the 'ndjson' output mode"}), 400
+    if aggregations and output_location:
+        return json.dumps({"error": "'aggregate' can not be combined with 'output_location'"}), 400
+
+    from google.cloud import storage
 
     storage_client = storage.Client()
 
-    # Getting all form blobs
-    form_blobs = []
-    for suffix in unpack_ranges(form_storage_suffix):
-        form_blobs.extend(storage_client.list_blobs(
+    matching_forms = _iter_matching_forms(storage_client, form_storage_suffixes, query_rules, result_limit)
+    compiled_output_format = _compile_output_format(output_format)
+    matches = (
+        _format_output(compiled_output_format, blob_name, raw_form_data)
+        for blob_name, raw_form_data in matching_forms
+    )
+
+    if aggregations:
+        output_mode = "aggregate"
+
+    if output_mode == "ndjson":
+        from flask import Response
+
+        return Response(_to_ndjson(matches), status=200, mimetype="application/x-ndjson")
+
+    def collect_results():
+        if output_mode == "aggregate":
+            return _aggregate(matching_forms, aggregations)
+        if output_location:
+            return _write_ndjson(storage_client, matches, output_location)
+        return {"matching_forms": list(matches)}
+
+    # Profile this run (see `profile_from_arguments` for the options).
+    results, profile = profile_from_arguments(arguments.get("profiling"), storage_client, collect_results)
+
+    if profile:
+        results["profile"] = profile
+
+    return json.dumps(results), 200
+
+
+def _iter_matching_forms(storage_client, form_storage_suffixes, query_rules, result_limit):
+    """
+    Scans all forms matching the storage suffixes for forms passing the query rules.
+    The blobs are listed and scanned lazily, so matches are yielded as soon as they are found.
+
+    :return: The blob name and raw data of each matching form.
+    :rtype: Iterator[(str, dict)]
+    """
+
+    found = 0
+    for suffix in form_storage_suffixes:
+        logging.info(f"Scanning BLOBs with prefix '{ENTRY_FILEPATH_PREFIX + suffix}'.")
+
+        form_blobs = storage_client.list_blobs(
             bucket_or_name=IMAGE_STORE_BUCKET,
             prefix=ENTRY_FILEPATH_PREFIX + suffix
-        ))
+        )
+
+        for form_blob in form_blobs:
+            if not form_blob.size:
+                continue
+
+            json_blob_data = form_blob.download_as_text()
+            raw_form_data = json.loads(json_blob_data)
+
+            success, alert = is_passing_rules(raw_form_data, query_rules)
+
+            if success:
+                logging.info(f"BLOB '{form_blob.name}' matched the query.")
+                if alert:
+                    logging.info(str(alert))
+                yield form_blob.name, raw_form_data
+                found += 1
+                if result_limit and found >= result_limit:
+                    return
 
-    results = {
-        "matching_forms": []
+
+def _compile_output_format(output_format) -> list:
+    """
+    Parses the output format once: each value is either a `$BLOB_NAME` template or a compiled path.
+
+    :return: The key, template (or `None`) and compiled path (or `None`) of each output field.
+    :rtype: list[(str, str | None, CompiledPath | None)]
+    """
+
+    return [
+        (key, value, None) if "$BLOB_NAME" in value else (key, None, compile_path(value))
+        for key, value in output_format.items()
+    ]
+
+
+def _format_output(compiled_output_format, blob_name, raw_form_data) -> dict:
+    output = {}
+    for key, template, var_path in compiled_output_format:
+        if template is not None:
+            output[key] = template.replace("$BLOB_NAME", blob_name)
+        else:
+            output[key] = var_path.get(raw_form_data)
+
+    return output
+
+
+def _aggregate(matching_forms, aggregations) -> dict:
+    """
+    Aggregates the matching forms, the forms themselves are not kept.
+
+    :return: The result of each aggregation (by name).
+    :rtype: dict
+    """
+
+    for _, raw_form_data in matching_forms:
+        for aggregation in aggregations:
+            aggregation.add(raw_form_data)
+
+    return {
+        "aggregations": {aggregation.name: aggregation.result() for aggregation in aggregations}
     }
 
-    found = 0
-    logging.info(f"Scanning '{len(form_blobs)}' BLOBs.")
-
-    for form_blob in form_blobs:
-        if not form_blob.size:
-            continue
-
-        json_blob_data = form_blob.download_as_text()
-        raw_form_data = json.loads(json_blob_data)
-
-        success, alert = is_passing_rules(raw_form_data, query_rules)
-
-        if success:
-            output = output_format.copy()
-            for key, value in output.items():
-                if "$BLOB_NAME" in value:
-                    output[key] = value.replace("$BLOB_NAME", form_blob.name)
-                else:
-                    output[key] = get_from_path(raw_form_data, value)
-            logging.info(f"BLOB '{form_blob.name}' matched the query.")
-            if alert:
-                logging.info(str(alert))
-            results["matching_forms"].append(output)
-            found += 1
-            if result_limit and found >= result_limit:
-                break
 
-    return json.dumps(results), 200
+def _to_ndjson(matches):
+    for match in matches:
+        yield json.dumps(match) + "\n"
+
+
+def _write_ndjson(storage_client, matches, output_location) -> dict:
+    """
+    Writes the matches as newline-delimited JSON to a storage object.
+    The matches are spooled to a temporary file, so they are never all kept in memory.
+
+    :return: The location of the object and the amount of matching forms.
+    :rtype: dict
+    """
+
+    count = 0
+    with tempfile.TemporaryFile("w+b") as spool:
+        for line in _to_ndjson(matches):
+            spool.write(line.encode("utf-8"))
+            count += 1
+
+        spool.seek(0)
+        blob = storage_client.bucket(output_location["bucket"]).blob(output_location["blob"])
+        blob.upload_from_file(spool, content_type="application/x-ndjson")
+
+    return {
+        "location": f"gs://{output_location['bucket']}/{output_location['blob']}",
+        "matching_form_count": count
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import json
+import logging
+
+from config import TOPIC_NAME_FALLBACK
+
+from functions.common.dead_letter_service import DeadLetterService
+from functions.common.form_object import Form
+from functions.common.metrics import get_metrics
+from functions.common.publish_service import PublishService
+from functions.common.utils import get_request_arguments
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def handler(request):
+    """
+    This cloud function replays the forms that could not be sent to ArcGIS
+    (recorded by get_images and sync_images), instead of scanning all form entries again.
+
+    :param request: The request to this cloud function.
+    :type request: flask.Request
+
+    :return: The result of this cloud function., An HTTP status code.
+    :rtype: str, int
+    """
+
+    from gobits import Gobits
+    from google.cloud import storage
+
+    # Initializing components
+    arguments = get_request_arguments(request)
+
+    # The amount of recorded forms that are replayed together.
+    batch_size = int(arguments.get("batch_size", 100))
+
+    # The maximum amount of batches of this run (0 for no maximum).
+    max_batches = int(arguments.get("max_batches", 0))
+
+    # Forms that failed this many times are moved aside instead of being recorded again.
+    max_attempts = int(arguments.get("max_attempts", 5))
+
+    # Options for request retry.
+    request_retry_options = arguments.get("request_retry_options", {
+        "retries": 6,
+        "backoff": 10,
+        "status_forcelist": [
+            404, 500, 502, 503, 504
+        ]
+    })
+
+    # Collect per-stage timings and counters (defaults to the ENABLE_METRICS environment variable).
+    metrics = get_metrics("replay_forms", enabled=arguments.get("enable_metrics"))
+
+    storage_client = storage.Client()
+    dead_letter_service = DeadLetterService(storage_client)
+
+    # Failed replays are recorded by the drain, so the publish service does not record them itself.
+    publish_service = PublishService(TOPIC_NAME_FALLBACK, metrics=metrics, **request_retry_options)
+    gobits = Gobits.from_request(request=request)
+
+    def replay(record: dict) -> bool:
+        form_blob = storage_client.bucket(record["bucket"]).get_blob(record["blob"])
+        if not form_blob:
+            logging.warning(f"Recorded form '{record['blob']}' no longer exists, dropping it.")
+            return True
+
+        form = Form.from_blob(form_blob)
+        if not form:
+            logging.error(f"Recorded form '{record['blob']}' is not a valid form, dropping it.")
+            return True
+
+        try:
+            return publish_service.publish_form(form, gobits)
+        except Exception as exception:
+            logging.error(f"Could not replay form '{record['blob']}': {exception}")
+            return False
+
+    # The summary is also logged when the run fails.
+    try:
+        result = dead_letter_service.drain(replay, batch_size, max_batches, max_attempts)
+    finally:
+        metrics.log_summary()
+
+    if metrics.enabled:
+        result["metrics"] = metrics.summary()
+
+    return json.dumps(result), 200
+
+
+if __name__ == "__main__":
+    request = None
+    handler(request)
@@ -1,6 +1,10 @@
 import re
+import itertools
 import json
+import base64
 import logging
+import time
+import uuid
 
 from config import (
     IMAGE_STORE_BUCKET,
@@ -10,17 +14,26 @@ from config import (
 
 from datetime import datetime, timedelta, timezone
 from functions.common.attachment_service import AttachmentService
+from functions.common.dead_letter_service import DeadLetterService
 from functions.common.form_object import Form
+from functions.common.metrics import get_metrics, NULL_METRICS
+from functions.common.profiler import create_profiler, profile_from_arguments
 from functions.common.publish_service import PublishService
-from functions.common.requests_retry_session import get_requests_session
-from functions.common.utils import unpack_ranges, get_request_arguments
-from gobits import Gobits
-from google.cloud import storage
+from functions.common.shard_service import ShardService
+from functions.common.utils import (
+    get_time_partition_step,
+    iter_ranges,
+    iter_time_partitions,
+    intersect_prefixes,
+    get_request_arguments
+)
+from functions.common.constant import HTTP_COORDINATOR_SECONDS, MAX_RANGE_COMBINATIONS, STORAGE_BATCH_SIZE
 
 
 logging.basicConfig(level=logging.INFO)
 
-REQUEST_RETRY_SESSION = get_requests_session()
+# Amount of forms of which the attachments are checked together (in batch requests).
+FORM_PAGE_SIZE = STORAGE_BATCH_SIZE
 
 
 def handler(request):
@@ -39,11 +52,277 @@ def handler(request):
     :rtype: str, int
     """
 
+    from gobits import Gobits
+    from google.cloud import storage
+
     # Initializing components
     arguments = get_request_arguments(request)
 
-    # Can be used to specify a sub directory.
+    # Reject storage suffixes that unpack to too many prefixes, before doing any work.
+    form_storage_suffix = arguments.get("form_storage_suffix", "")
+    for storage_suffix in form_storage_suffix if isinstance(form_storage_suffix, list) else [form_storage_suffix]:
+        try:
+            iter_ranges(storage_suffix, MAX_RANGE_COMBINATIONS)
+        except ValueError as exception:
+            return json.dumps({"error": str(exception)}), 400
+
+    # Reject time partition formats that can not be stepped through, before doing any work.
+    time_partitioning = arguments.get("time_partitioning")
+    if isinstance(time_partitioning, dict):
+        try:
+            get_time_partition_step(time_partitioning.get("format", "/%Y/%m/%d"))
+        except ValueError as exception:
+            return json.dumps({"error": str(exception)}), 400
+
+    # Reject invalid copy sources, before listing (these are checked by the attachment service as well).
+    try:
+        AttachmentService.validate_copy_sources(arguments.get("attachment_copy_sources", []))
+    except ValueError as exception:
+        return json.dumps({"error": str(exception)}), 400
+
+    # Reject invalid sharding options, before listing.
+    if "sharding" in arguments:
+        try:
+            _validate_sharding(arguments)
+        except ValueError as exception:
+            return json.dumps({"error": str(exception)}), 400
+
+    # Reject invalid profiling options, before doing any work.
+    try:
+        create_profiler(arguments.get("profiling"))
+    except ValueError as exception:
+        return json.dumps({"error": str(exception)}), 400
+
+    storage_client = storage.Client()
+
+    # Merge the reports of shards that were dispatched over Pub/Sub.
+    if "collect_shard_reports" in arguments:
+        report_location = arguments["collect_shard_reports"]
+        result = ShardService.collect_reports(storage_client, report_location["bucket"], report_location["prefix"])
+        return json.dumps(result), 200
+
+    # Split the run into shards and fan them out to workers.
+    if "sharding" in arguments:
+        return json.dumps(_coordinate(arguments, storage_client)), 200
+
+    # Profile this run (see `profile_from_arguments` for the options).
+    gobits = Gobits.from_request(request=request)
+    result, profile = profile_from_arguments(
+        arguments.get("profiling"), storage_client, _synchronize, gobits, arguments, storage_client
+    )
+
+    if profile:
+        result["profile"] = profile
+
+    return json.dumps(result), 200
+
+
+def pubsub_handler(data, context):
+    """
+    Worker entry point for shards dispatched over Pub/Sub.
+    The message data holds the same arguments as the HTTP handler.
+
+    :param: data    Dictionary like object that holds trigger information.
+    :param: context Google Cloud Function context.
+    """
+
+    from gobits import Gobits
+    from google.cloud import storage
+
+    arguments = json.loads(base64.b64decode(data["data"]).decode("utf-8"))
+    gobits = Gobits.from_context(context=context)
+
+    result = _synchronize(gobits, arguments, storage.Client())
+    logging.info(f"Shard result: {json.dumps(result)}")
+
+
+def _coordinate(arguments, storage_client) -> dict:
+    """
+    Splits the run into shards and dispatches them to worker invocations.
+
+    Over HTTP the coordinator waits for the workers and merges their counters into one report.
+    Over Pub/Sub the workers write their result to the report location (if specified),
+    which can be merged afterwards with `collect_shard_reports`.
+
+    :return: The merged report (HTTP) or the dispatched messages (Pub/Sub).
+    :rtype: dict
+    """
+
+    # Over HTTP the coordinator waits for the workers, within its own time limit.
+    deadline = time.monotonic() + HTTP_COORDINATOR_SECONDS
+
+    sharding = arguments["sharding"]
+    shard_service = ShardService(int(sharding["shard_count"]), sharding.get("strategy", "hash"))
+
+    # The workers get their own slice of the blobs, so the slicing arguments are not passed along.
+    worker_arguments = {
+        key: value for key, value in arguments.items()
+        if key not in ("sharding", "form_index_range")
+    }
+
+    coordinate_time = datetime.now(timezone.utc)
+
+    # Every run writes its reports to its own location, so reports of earlier runs are never merged.
+    run_id = f"{coordinate_time:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+    if "report_bucket" in sharding:
+        worker_arguments["shard_report"] = {
+            "bucket": sharding["report_bucket"],
+            "prefix": f"{sharding.get('report_prefix', 'sync_images/shards')}/{run_id}",
+        }
+
+    # Only the prefixes that can hold blobs of the time window are split and listed.
+    worker_arguments["form_storage_suffix"] = _plan_storage_suffixes(arguments, coordinate_time)
+
+    max_time_delta = timedelta(**arguments["max_time_delta"]) if "max_time_delta" in arguments else None
+
+    def list_blobs():
+        form_blobs = _list_form_blobs(
+            storage_client,
+            worker_arguments["form_storage_suffix"],
+            arguments.get("form_index_range")
+        )
+
+        # Blobs outside the time window are dropped before they are dispatched.
+        return [
+            form_blob for form_blob in form_blobs
+            if not max_time_delta or coordinate_time - form_blob.time_created <= max_time_delta
+        ]
+
+    shards = shard_service.plan(worker_arguments, list_blobs)
+
+    logging.info(f"Dispatching {len(shards)} shards ({shard_service.strategy}).")
+
+    if "worker_topic" in sharding:
+        message_ids = shard_service.dispatch_pubsub(sharding["worker_topic"], shards)
+        return {
+            "run_id": run_id,
+            "shard_count": len(shards),
+            "message_ids": message_ids,
+            "shard_report": worker_arguments.get("shard_report"),
+        }
+
+    results = shard_service.dispatch_http(
+        sharding["worker_url"],
+        shards,
+        timeout=sharding.get("timeout", 540),
+        max_workers=sharding.get("max_concurrent_shards", 16),
+        deadline=deadline
+    )
+
+    return {"run_id": run_id, **shard_service.merge_results(results)}
+
+
+def _validate_sharding(arguments):
+    """
+    Checks the sharding options of a run, so the coordinator does not fail after listing.
+
+    :raises ValueError: If the sharding options are invalid.
+    """
+
+    sharding = arguments["sharding"]
+    if not isinstance(sharding, dict):
+        raise ValueError("The sharding options must be an object")
+
+    try:
+        shard_count = int(sharding["shard_count"])
+        int(sharding.get("max_concurrent_shards", 16))
+        float(sharding.get("timeout", 540))
+    except KeyError:
+        raise ValueError("The sharding options require a shard_count")
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid sharding options: {json.dumps(sharding)}")
+
+    # Raises on an unknown strategy or shard count.
+    strategy = ShardService(shard_count, sharding.get("strategy", "hash")).strategy
+
+    if "worker_url" not in sharding and "worker_topic" not in sharding:
+        raise ValueError("The sharding options require a worker_url or worker_topic")
+    if strategy == "prefix" and "form_index_range" in arguments:
+        raise ValueError("The prefix strategy does not support form_index_range, use the hash strategy instead")
+
+
+def _plan_storage_suffixes(arguments, process_start_time):
+    """
+    Returns the storage suffix(es) to list.
+
+    With `max_time_delta` and `time_partitioning` the time window is mapped onto the date-structured
+    entry prefixes, intersected with the `form_storage_suffix`. So only the prefixes that can hold
+    blobs of the time window are listed, instead of the full history.
+
+    :return: The storage suffix (ranges supported) or list of storage suffixes.
+    :rtype: str | list[str]
+    """
+
     form_storage_suffix = arguments.get("form_storage_suffix", "")
+    time_partitioning = arguments.get("time_partitioning", False)
+
+    if time_partitioning is False or "max_time_delta" not in arguments:
+        return form_storage_suffix
+
+    # `true` uses the default options.
+    if not isinstance(time_partitioning, dict):
+        time_partitioning = {}
+
+    # The margin covers blobs that are stored in a partition other than their creation time (e.g. time zones).
+    margin = timedelta(**time_partitioning.get("margin", {"days": 1}))
+    start = process_start_time - timedelta(**arguments["max_time_delta"]) - margin
+    end = process_start_time + margin
+
+    partitions = iter_time_partitions(start, end, time_partitioning.get("format", "/%Y/%m/%d"))
+
+    storage_suffixes = form_storage_suffix if isinstance(form_storage_suffix, list) else [form_storage_suffix]
+    storage_suffixes = intersect_prefixes(
+        itertools.chain.from_iterable(iter_ranges(suffix, MAX_RANGE_COMBINATIONS) for suffix in storage_suffixes),
+        partitions
+    )
+
+    logging.info(f"Time partitions to list: {len(storage_suffixes)}")
+
+    return storage_suffixes
+
+
+def _list_form_blobs(storage_client, form_storage_suffix, form_index_range=None, metrics=NULL_METRICS) -> list:
+    """
+    Lists all form blobs of the specified storage suffix(es), optionally sliced by an index range.
+
+    :return: The listed form blobs.
+    :rtype: list
+    """
+
+    form_storage_suffixes = form_storage_suffix if isinstance(form_storage_suffix, list) else [form_storage_suffix]
+
+    # Getting all form blobs
+    form_blobs = []
+    with metrics.span("blob_listing"):
+        for storage_suffix in form_storage_suffixes:
+            for suffix in iter_ranges(storage_suffix, MAX_RANGE_COMBINATIONS):
+                form_blobs.extend(storage_client.list_blobs(
+                    bucket_or_name=IMAGE_STORE_BUCKET,
+                    prefix=ENTRY_FILEPATH_PREFIX + suffix
+                ))
+
+    logging.info(f"Getting all blobs from: {', '.join(ENTRY_FILEPATH_PREFIX + s for s in form_storage_suffixes)}")
+    logging.info(f"Found blobs: {len(form_blobs)}")
+
+    if form_index_range:
+        match = re.match(r"^(\d+):(\d+)$", form_index_range)
+        if match:
+            start = match.group(1)
+            end = match.group(2)
+            form_blobs = form_blobs[int(start):int(end)]
+            logging.info(f"Index range: start: {start} ({form_blobs[0].name}), end: {end} ({form_blobs[-1].name})")
+
+    return form_blobs
+
+
+def _synchronize(gobits, arguments, storage_client) -> dict:
+    """
+    Scans the forms specified by the arguments and repairs their attachments and ArcGIS features.
+
+    :return: The counters of this run.
+    :rtype: dict
+    """
 
     # Range of indexes
     form_index_range = arguments.get("form_index_range")
@@ -54,12 +333,21 @@ def handler(request):
     # Download missing attachments.
     enable_attachment_downloading = arguments.get("enable_attachment_downloading", True)
 
+    # Copy attachments with already stored content within storage instead of downloading them.
+    enable_attachment_deduplication = arguments.get("enable_attachment_deduplication", False)
+
+    # Buckets to copy missing attachments from before downloading them.
+    attachment_copy_sources = arguments.get("attachment_copy_sources", [])
+
     # Send entries to ArcGIS when changed.
     enable_arcgis_updating = arguments.get("enable_arcgis_updating", True)
 
     # Always send entries to ArcGIS.
     force_arcgis_updating = arguments.get("force_arcgis_updating", False)
 
+    # Record forms that could not be sent to ArcGIS, so they can be replayed (see replay_forms).
+    enable_dead_letter = arguments.get("enable_dead_letter", True)
+
     # Options for request retry.
     request_retry_options = arguments.get("request_retry_options", {
         "retries": 6,
@@ -69,91 +357,177 @@ def handler(request):
         ]
     })
 
+    # Collect per-stage timings and counters (defaults to the ENABLE_METRICS environment variable).
+    metrics = get_metrics("sync_images", enabled=arguments.get("enable_metrics"))
+
     # Get the current time for delta time calculations.
     process_start_time = datetime.now(timezone.utc)  # timestamp must be timezone aware and conform to RFC3339
 
-    storage_client = storage.Client()
-    attachment_service = AttachmentService(storage_client, **request_retry_options)
-    publish_service = PublishService(TOPIC_NAME_FALLBACK, **request_retry_options)
+    attachment_service = AttachmentService(
+        storage_client,
+        metrics=metrics,
+        deduplicate=enable_attachment_deduplication,
+        copy_sources=attachment_copy_sources,
+        **request_retry_options
+    )
+    publish_service = PublishService(
+        TOPIC_NAME_FALLBACK,
+        metrics=metrics,
+        dead_letter_service=DeadLetterService(storage_client) if enable_dead_letter else None,
+        **request_retry_options
+    )
+
+    # The summary is also logged when the run fails.
+    try:
+        if "form_blobs" in arguments:
+            # Shard worker: the coordinator already listed the blobs.
+            bucket = storage_client.bucket(IMAGE_STORE_BUCKET)
+            form_blobs = [ShardService.blob_from_dict(bucket, blob) for blob in arguments["form_blobs"]]
+            logging.info(f"Received blobs: {len(form_blobs)}")
+        else:
+            # The sub directory (or a list of them), narrowed down to the time window when time partitioned.
+            form_blobs = _list_form_blobs(
+                storage_client,
+                _plan_storage_suffixes(arguments, process_start_time),
+                form_index_range,
+                metrics
+            )
+
+        result = {
+            "total_form_count": 0,
+            "form_with_missing_attachment_count": 0,
+            "missing_attachment_count": 0,
+            "downloaded_attachment_count": 0,
+            "failed_form_count": 0
+        }
+
+        # Looping through all forms to check them.
+        forms = _load_forms(form_blobs, max_time_delta, process_start_time, metrics)
+        for form_page in _paginate(forms, FORM_PAGE_SIZE):
+            # Find all the page's attachments that are not available in storage (in batches).
+            missing_attachments_per_form = attachment_service.find_missing_attachments_many(
+                [form for _, form in form_page]
+            )
+
+            # Look up the coordinates of the page's forms that will be sent to ArcGIS together.
+            publish_service.prefetch_coordinates([
+                form for (_, form), missing_attachments in zip(form_page, missing_attachments_per_form)
+                if _is_publishing(
+                    missing_attachments,
+                    enable_attachment_downloading,
+                    enable_arcgis_updating,
+                    force_arcgis_updating
+                )
+            ])
 
-    # Getting all form blobs
-    form_blobs = []
-    for suffix in unpack_ranges(form_storage_suffix):
-        form_blobs.extend(storage_client.list_blobs(
-            bucket_or_name=IMAGE_STORE_BUCKET,
-            prefix=ENTRY_FILEPATH_PREFIX + suffix
-        ))
+            # Copying or downloading the page's missing attachments to storage (concurrently).
+            responses = iter([])
+            if enable_attachment_downloading:
+                page_missing_attachments = list(itertools.chain.from_iterable(missing_attachments_per_form))
+                if page_missing_attachments:
+                    logging.info(
+                        f"Found {len(page_missing_attachments)} missing attachments, attempting to download..."
+                    )
+                    responses = iter(attachment_service.repair_many(page_missing_attachments))
+                    logging.info("Download(s) complete.")
+
+            for (form_blob, form), missing_attachments in zip(form_page, missing_attachments_per_form):
+                result["total_form_count"] += 1
+                _repair_form(
+                    gobits, form_blob, form, missing_attachments,
+                    list(itertools.islice(responses, len(missing_attachments))), result, publish_service,
+                    enable_attachment_downloading, enable_arcgis_updating, force_arcgis_updating
+                )
+    finally:
+        metrics.log_summary()
 
-    logging.info(f"Getting all blobs from: {ENTRY_FILEPATH_PREFIX + form_storage_suffix}")
-    logging.info(f"Found blobs: {len(form_blobs)}")
+    if metrics.enabled:
+        result["metrics"] = metrics.summary()
 
-    if form_index_range:
-        match = re.match(r"^(\d+):(\d+)$", form_index_range)
-        if match:
-            start = match.group(1)
-            end = match.group(2)
-            form_blobs = form_blobs[int(start):int(end)]
-            logging.info(f"Index range: start: {start} ({form_blobs[0].name}), end: {end} ({form_blobs[-1].name})")
+    if "shard_report" in arguments:
+        report_location = arguments["shard_report"]
+        report_blob = storage_client.bucket(report_location["bucket"]).blob(
+            f"{report_location['prefix']}/{arguments['shard']['index']}.json"
+        )
+        report_blob.upload_from_string(json.dumps(result), content_type="application/json")
+
+    return result
 
-    result = {
-        "total_form_count": 0,
-        "form_with_missing_attachment_count": 0,
-        "missing_attachment_count": 0,
-        "downloaded_attachment_count": 0
-    }
 
-    # Looping through all forms to check them.
+def _load_forms(form_blobs, max_time_delta, process_start_time, metrics):
+    """
+    Yields all valid forms (and their blob) of the specified blobs that do not exceed the max age.
+    """
+
     for form_blob in form_blobs:
         # Check if blob creation time does not exceed max age.
         if max_time_delta and process_start_time - form_blob.time_created > max_time_delta:
             continue
 
-        form = Form.from_blob(form_blob)
+        with metrics.span("blob_fetch"):
+            form = Form.from_blob(form_blob)
 
-        if not form:
-            continue
+        if form:
+            yield form_blob, form
 
-        result["total_form_count"] += 1
 
-        # Find all a form's attachments that are not available in storage.
-        missing_attachments = attachment_service.find_missing_attachments(form)
+def _paginate(iterable, page_size):
+    page = []
+    for item in iterable:
+        page.append(item)
+        if len(page) >= page_size:
+            yield page
+            page = []
 
-        if missing_attachments:
-            missing_attachment_count = len(missing_attachments)
-            result["form_with_missing_attachment_count"] += 1
-            result["missing_attachment_count"] += missing_attachment_count
+    if page:
+        yield page
 
-            if enable_attachment_downloading:
-                logging.info(
-                    f"Found {missing_attachment_count} missing attachments for {form_blob.name}, "
-                    "attempting to download..."
+
+def _is_publishing(
+        missing_attachments, enable_attachment_downloading, enable_arcgis_updating, force_arcgis_updating
+) -> bool:
+    """
+    Checks if a form is sent to ArcGIS: when its missing attachments are downloaded, or always when forced.
+    """
+
+    downloaded_missing_attachments = missing_attachments and enable_attachment_downloading
+    return bool((downloaded_missing_attachments and enable_arcgis_updating) or force_arcgis_updating)
+
+
+def _repair_form(
+        gobits, form_blob, form, missing_attachments, responses, result,
+        publish_service,
+        enable_attachment_downloading, enable_arcgis_updating, force_arcgis_updating
+):
+    """
+    Counts the restored missing attachments of a form (`responses`, see `repair_many`)
+    and sends it to ArcGIS when needed.
+    """
+
+    if missing_attachments:
+        result["form_with_missing_attachment_count"] += 1
+        result["missing_attachment_count"] += len(missing_attachments)
+
+        for attachment, (success, response) in zip(missing_attachments, responses):
+            if success:
+                result["downloaded_attachment_count"] += 1
+            else:
+                logging.error(
+                    "Error downloading image.\n"
+                    f"Form: {form_blob.name}\n"
+                    f"URL: {attachment.download_url}\n"
+                    f"Bucket path: {attachment.bucket_path}\n"
+                    f"Response: {response}"
                 )
 
-                for attachment in missing_attachments:
-                    # Downloading attachment to storage.
-                    success, response = attachment_service.download(attachment)
-                    if success:
-                        result["downloaded_attachment_count"] += 1
-                    else:
-                        logging.error(
-                            "Error downloading image.\n"
-                            f"Form: {form_blob.name}\n"
-                            f"URL: {attachment.download_url}\n"
-                            f"Bucket path: {attachment.bucket_path}\n"
-                            f"Response: {response}"
-                        )
-
-                logging.info("Download(s) complete.")
-
-        downloaded_missing_attachments = missing_attachments and enable_attachment_downloading
-        if (downloaded_missing_attachments and enable_arcgis_updating) or force_arcgis_updating:
-            logging.info("Sending form to ArcGIS...")
-
-            # Sending the form to ArcGIS
-            gobits = Gobits.from_request(request=request)
-            publish_service.publish_form(form, metadata=gobits)
+    if _is_publishing(
+            missing_attachments, enable_attachment_downloading, enable_arcgis_updating, force_arcgis_updating
+    ):
+        logging.info("Sending form to ArcGIS...")
 
-    return json.dumps(result), 200
+        # Sending the form to ArcGIS
+        if not publish_service.publish_form(form, metadata=gobits):
+            result["failed_form_count"] += 1
 
 
 if __name__ == "__main__":